@@ -0,0 +1,175 @@
+"""
+Measures the throughput of the SSH tunnel with the old per-connection select loop (1 KiB reads)
+and with the Relay event loop. A paramiko server on localhost stands in for CAE: it accepts
+keyboard-interactive logins without prompts and forwards direct-tcpip channels to a local
+server that streams --megabytes of data to every connection
+"""
+from wa_infra_tools.ssh_utils.SSHClient import SSHClient, ForwardServer, Handler
+import argparse
+import paramiko
+import select
+import socket
+import threading
+import time
+
+CHUNK = b"\0" * (256 * 1024)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="compares ssh tunnel relay implementations")
+    parser.add_argument("--megabytes", type=int, default=200, help="data sent through each connection")
+    parser.add_argument("--connections", type=int, default=4, help="connections open at once")
+    return parser.parse_args()
+
+class StandInServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return "keyboard-interactive"
+
+    def check_auth_interactive(self, username, submethods):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+def listen(handle_connection):
+    """
+    Accepts connections on a free localhost port, handling each in a thread
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(64)
+    def accept():
+        while True:
+            conn, _ = sock.accept()
+            threading.Thread(target=handle_connection, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    return sock.getsockname()[1]
+
+def start_source(megabytes):
+    """
+    Starts a server that sends megabytes of data to each connection and then closes it
+    """
+    def send(conn):
+        remaining = megabytes * 1024 * 1024
+        while remaining > 0:
+            conn.sendall(CHUNK[:remaining])
+            remaining -= len(CHUNK)
+        conn.close()
+    return listen(send)
+
+def start_ssh_server():
+    """
+    Starts the paramiko stand-in for the CAE ssh server
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    def serve(conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        # SSHClient transfers files over sftp sessions
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer)
+        server = StandInServer()
+        server.destinations = {}
+        transport.start_server(server=server)
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None and channel.get_id() in server.destinations:
+                threading.Thread(target=forward, args=(channel, server.destinations[channel.get_id()]), daemon=True).start()
+    def forward(channel, destination):
+        sock = socket.create_connection(destination)
+        def upstream():
+            try:
+                while True:
+                    data = channel.recv(len(CHUNK))
+                    if not data:
+                        break
+                    sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+            except OSError: # the downstream side finished first and closed the socket
+                pass
+        threading.Thread(target=upstream, daemon=True).start()
+        while True:
+            data = sock.recv(len(CHUNK))
+            if not data:
+                break
+            channel.sendall(data)
+        channel.close()
+        sock.close()
+    return listen(serve)
+
+class LegacyHandler(Handler):
+    """
+    The relay loop used before the Relay class: one thread per connection copying 1 KiB at a time
+    """
+    def handle(self):
+        channel = self.transport.open_channel("direct-tcpip", (self.chan_host, self.chan_port), self.request.getpeername())
+        while True:
+            read_list = select.select([self.request, channel], [], [])[0]
+            if self.request in read_list:
+                data = self.request.recv(1024)
+                if len(data) == 0:
+                    break
+                channel.send(data)
+            if channel in read_list:
+                data = channel.recv(1024)
+                if len(data) == 0:
+                    break
+                self.request.send(data)
+        channel.close()
+        self.request.close()
+
+def legacy_tunnel(transport, local_port, remote_host, remote_port):
+    class SubHandler(LegacyHandler):
+        chan_host = remote_host
+        chan_port = remote_port
+    SubHandler.transport = transport
+    server = ForwardServer(("", local_port), SubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def measure(local_port, megabytes, connections):
+    """
+    Reads everything the source sends through the tunnel on several connections at once
+
+    @return float - MB/s over all connections
+    """
+    def read():
+        sock = socket.create_connection(("127.0.0.1", local_port))
+        buffer = bytearray(1 << 20)
+        while sock.recv_into(buffer):
+            pass
+        sock.close()
+    start = time.time()
+    threads = [threading.Thread(target=read) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return megabytes * connections / (time.time() - start)
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+if __name__ == "__main__":
+    args = parse_args()
+    source_port = start_source(args.megabytes)
+    ssh_port = start_ssh_server()
+    client = SSHClient("benchmark", f"127.0.0.1:{ssh_port}")
+
+    legacy_port = free_port()
+    server = legacy_tunnel(client.transport, legacy_port, "127.0.0.1", source_port)
+    legacy = measure(legacy_port, args.megabytes, args.connections)
+    server.shutdown()
+    print(f"select loop, 1 KiB reads: {legacy:.1f} MB/s")
+
+    relay_port = free_port()
+    client.start_tunnel(relay_port, "127.0.0.1", source_port)
+    relay = measure(relay_port, args.megabytes, args.connections)
+    client.stop_tunnels()
+    print(f"relay event loop:         {relay:.1f} MB/s ({relay / legacy:.1f}x)")
@@ -0,0 +1,48 @@
+from wa_infra_tools.database.labels import label_columns, format_labels
+from collections import defaultdict
+import argparse
+import random
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="compares per-row and vectorized yolo label formatting")
+    parser.add_argument("--boxes", type=int, default=3000000)
+    parser.add_argument("--boxes-per-image", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    return parser.parse_args()
+
+def per_row(rows):
+    # how labels were built before: one list comprehension and string concatenation per row
+    label_dict = defaultdict(str)
+    for row in rows:
+        label = " ".join([str(row[i]) for i in range(1, 6)])
+        label_dict[row[0]] += label + "\n"
+    return label_dict
+
+def vectorized(rows, batch_size):
+    labels = {}
+    for i in range(0, len(rows), batch_size):
+        image_ids, columns = label_columns(rows[i:i + batch_size], 0, [1, 2, 3, 4, 5])
+        _, groups = format_labels(image_ids, columns, 6)
+        for image_id, _, _, label in groups:
+            labels[image_id] = labels.get(image_id, "") + label
+    return labels
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(0)
+    rows = [
+        (i // args.boxes_per_image, random.randrange(4), random.random(), random.random(), random.random(), random.random())
+        for i in range(args.boxes)
+    ]
+    print(f"{args.boxes} boxes in {args.boxes // args.boxes_per_image} images")
+
+    start = time.time()
+    per_row(rows)
+    per_row_time = time.time() - start
+    print(f"per row:    {per_row_time:.2f}s")
+
+    start = time.time()
+    vectorized(rows, args.batch_size)
+    vectorized_time = time.time() - start
+    print(f"vectorized: {vectorized_time:.2f}s ({per_row_time / vectorized_time:.1f}x)")
@@ -13,6 +13,8 @@ IMAGE_HEIGHT = 720
 with open(labels_path) as f:
     labels = json.load(f)
 
+label_rows = []
+
 for i in tqdm(range(len(labels))):
     image_label = labels[i]
     if "labels" not in image_label.keys():
@@ -62,6 +64,7 @@ for i in tqdm(range(len(labels))):
             "image_id": image_id,
             "dataset": "bdd100k"
         }
-        db.insert_row("test_bb_labels", label_dict)
+        label_rows.append(label_dict)
 
+db.insert_rows("test_bb_labels", label_rows)
 db.commit()
@@ -0,0 +1,305 @@
+"""
+This file contains the AsyncPostgresDatabase class which gives asyncio code access to
+the database and CAE storage over the tunnel of a PostgresDatabase
+"""
+import asyncio
+import contextlib
+import itertools
+import psycopg2
+import psycopg2.extensions
+from concurrent.futures import ThreadPoolExecutor
+from wa_infra_tools.database.PostgresDatabase import PostgresDatabase
+from wa_infra_tools.database.ImageTransfer import ImageTransfer
+
+class AsyncPostgresDatabase:
+    def __init__(self, database, transfer_workers=None):
+        """
+        Constructs an AsyncPostgresDatabase object that reuses the tunnel and SSH transport of database.
+        Call open (or use AsyncPostgresDatabase.connect) before running queries
+
+        @param database : PostgresDatabase  - connected database whose tunnel is reused
+        @param transfer_workers : int       - number of transfers run at once, limited by the SFTP sessions of database.client
+                                              (default: transfer_workers of database)
+        """
+        self.database = database
+        self.transfer = ImageTransfer(
+            database.client,
+            workers=transfer_workers or database.transfer.workers,
+            max_retries=database.transfer.max_retries
+        )
+        # every transfer is queued on a fixed set of threads (one per SFTP session), however many are awaited at once
+        self._executor = ThreadPoolExecutor(self.transfer.workers)
+
+        self._connections = None
+        self._all_connections = []
+        self._cursor_ids = itertools.count(1)
+        self._owns_database = False
+
+    @classmethod
+    async def connect(cls, cae_username, hostname, connections=4, transfer_workers=8, **kwargs):
+        """
+        Sets up the SSH tunnel (the 2FA prompt runs in a thread so the event loop is not blocked)
+        and opens the async connections
+
+        @param cae_username : str       - username on cae network
+        @param hostname : str           - ip address or alias of host
+        @param connections : int        - number of database connections, i.e. queries that can run at once (default: 4)
+        @param transfer_workers : int   - number of pooled SFTP sessions (default: 8)
+        @param kwargs : any             - other arguments of PostgresDatabase
+        @return AsyncPostgresDatabase   - connected database
+        """
+        loop = asyncio.get_running_loop()
+        database = await loop.run_in_executor(
+            None,
+            lambda: PostgresDatabase(cae_username, hostname, transfer_workers=transfer_workers, **kwargs)
+        )
+        db = cls(database)
+        db._owns_database = True
+        await db.open(connections)
+        return db
+
+    async def open(self, connections=4):
+        """
+        Opens async (non-blocking) connections to the database through the tunnel
+
+        @param connections : int - number of connections, i.e. queries that can run at once (default: 4)
+        """
+        self._connections = asyncio.Queue()
+        for _ in range(connections):
+            connection = psycopg2.connect(self.database.conn_string, async_=True)
+            self._all_connections.append(connection)
+            await self._wait(connection)
+            self._connections.put_nowait(connection)
+
+    async def sql(self, sql_string, params=None):
+        """
+        Executes any sql command on the database without blocking the event loop. Unlike PostgresDatabase,
+        every command is committed when it finishes (several statements separated by ; run in one transaction)
+
+        @param sql_string : str     - string containing sql command
+        @param params : List[any]   - values substituted for %s placeholders in sql_string (default: None)
+        @return List[Tuple[any...]] - list of the result of the query (if there is a response)
+        """
+        async with self._lease() as connection:
+            cursor = connection.cursor()
+            try:
+                await self._execute(cursor, sql_string, params)
+                return cursor.fetchall() if cursor.description is not None else []
+            finally:
+                cursor.close()
+
+    async def iter_sql(self, sql_string, batch_size=1000, params=None):
+        """
+        Executes a query with a server-side cursor and yields the resulting rows as they arrive,
+        fetching batch_size rows at a time. The connection is held until the iteration ends
+
+        @param sql_string : str     - string containing sql query
+        @param batch_size : int     - number of rows fetched from the database at once (default: 1000)
+        @param params : List[any]   - values substituted for %s placeholders in sql_string (default: None)
+        @return AsyncIterator[Tuple[any...]] - rows of the result of the query
+        """
+        # async connections cannot use named cursors, so the cursor is declared in sql
+        name = f"wa_async_cursor_{next(self._cursor_ids)}"
+        async with self._lease() as connection:
+            cursor = connection.cursor()
+            try:
+                # the transaction (and the cursor declared in it) is rolled back when the connection is given back
+                await self._execute(cursor, "BEGIN")
+                await self._execute(cursor, f"DECLARE {name} NO SCROLL CURSOR FOR {sql_string}", params)
+                while True:
+                    await self._execute(cursor, f"FETCH {int(batch_size)} FROM {name}")
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    async def put_file(self, local_filepath, remote_path):
+        """
+        Sends one file to the remote machine
+
+        @param local_filepath : str - path to the file on the local machine
+        @param remote_path : str    - where to store the file on the remote machine
+        @return int                 - number of bytes sent
+        """
+        return await self._run(self.transfer.put_file, local_filepath, remote_path)
+
+    async def get_file(self, remote_path, local_filepath):
+        """
+        Receives one file from the remote machine
+
+        @param remote_path : str    - path to the file on the remote machine
+        @param local_filepath : str - where to store the file on the local machine
+        @return int                 - number of bytes received
+        """
+        return await self._run(self.transfer.get_file, remote_path, local_filepath)
+
+    async def upload(self, items):
+        """
+        Uploads files to the remote machine, all of them in flight at once. Every distinct
+        remote directory is created once before any file is sent
+
+        @param items : List[Tuple[str, str, str]]   - (local filepath, remote filepath, remote filename) of each file
+        @return int                                 - number of bytes sent
+        """
+        await self._run(self.transfer.make_remote_dirs, [remote_filepath for _, remote_filepath, _ in items])
+        sizes = await asyncio.gather(*[
+            self.put_file(local_filepath, remote_filepath + remote_filename)
+            for local_filepath, remote_filepath, remote_filename in items
+        ])
+        return sum(sizes)
+
+    async def download(self, items):
+        """
+        Downloads files from the remote machine, all of them in flight at once
+
+        @param items : List[Tuple[str, str]]    - (remote path, local filepath) of each file
+        @return int                             - number of bytes received
+        """
+        sizes = await asyncio.gather(*[self.get_file(remote_path, local_filepath) for remote_path, local_filepath in items])
+        return sum(sizes)
+
+    async def close(self):
+        """
+        Closes the async connections and idle SFTP sessions (and the PostgresDatabase if it was opened by connect)
+        """
+        for connection in self._all_connections:
+            connection.close()
+        self._all_connections = []
+        self._connections = None
+        await self._run(self.transfer.close)
+        self._executor.shutdown()
+        if self._owns_database:
+            self.database.close()
+
+    @contextlib.asynccontextmanager
+    async def _lease(self):
+        """
+        Takes a free connection for the duration of the block, waiting for one if they are all in use.
+        The connection is only given back once it is idle again (see _give_back)
+        """
+        assert self._connections is not None, "Call open before running queries"
+        connection = await self._connections.get()
+        try:
+            if connection.isexecuting():
+                # a replacement that was still connecting when it was given back
+                await self._wait(connection)
+            yield connection
+        finally:
+            await self._give_back(connection)
+
+    async def _give_back(self, connection):
+        """
+        Returns a leased connection to the free connections. A query still running on it is cancelled and drained
+        and an open (or failed) transaction rolled back; a connection that cannot be recovered that way is closed
+        and replaced by a new one, so the next lease never gets a busy or broken connection
+
+        @param connection : connection - leased connection
+        """
+        if self._connections is None:
+            return
+        try:
+            recovered = await self._recover(connection)
+        except psycopg2.Error:
+            recovered = False
+        except BaseException:
+            # cancelled again while recovering
+            self._connections.put_nowait(self._replace(connection))
+            raise
+        if self._connections is not None:
+            self._connections.put_nowait(connection if recovered else self._replace(connection))
+
+    async def _recover(self, connection):
+        """
+        Brings a connection back to idle: cancels a query still running on it and rolls back its transaction
+
+        @param connection : connection  - async connection
+        @return bool                    - whether the connection can be used again
+        """
+        if connection.closed:
+            return False
+        await self._cancel(connection)
+        if connection.closed or connection.isexecuting():
+            return False
+        if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            cursor = connection.cursor()
+            try:
+                await self._execute(cursor, "ROLLBACK")
+            finally:
+                cursor.close()
+        return connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def _replace(self, connection):
+        """
+        Closes a connection and starts opening a new one in its place (the connection is completed when it is leased)
+
+        @param connection : connection  - connection to close
+        @return connection              - new async connection
+        """
+        connection.close()
+        if connection in self._all_connections:
+            self._all_connections.remove(connection)
+        replacement = psycopg2.connect(self.database.conn_string, async_=True)
+        self._all_connections.append(replacement)
+        return replacement
+
+    async def _execute(self, cursor, sql_string, params=None):
+        """
+        Sends a command on an async cursor and waits for it to finish. If the wait is interrupted
+        (cancelled, timed out or failed) the command is cancelled on the server before the error is raised
+        """
+        cursor.execute(sql_string, params)
+        try:
+            await self._wait(cursor.connection)
+        except BaseException:
+            await self._cancel(cursor.connection)
+            raise
+
+    async def _cancel(self, connection):
+        """
+        Cancels the command running on an async connection, if any, and waits for the server to give up on it
+        """
+        if connection.closed or not connection.isexecuting():
+            return
+        try:
+            connection.cancel()
+            await self._wait(connection)
+        except psycopg2.Error:
+            # the server reports the cancelled (or failed) command here
+            pass
+
+    async def _run(self, func, *args):
+        """
+        Runs a blocking transfer function on the transfer threads
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    async def _wait(connection):
+        """
+        Waits for the current operation of an async connection to finish by polling it whenever its
+        socket is ready, so the event loop keeps running in the meantime
+
+        @param connection : connection - psycopg2 connection opened with async_=True
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            state = connection.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            if state == psycopg2.extensions.POLL_READ:
+                add, remove = loop.add_reader, loop.remove_reader
+            elif state == psycopg2.extensions.POLL_WRITE:
+                add, remove = loop.add_writer, loop.remove_writer
+            else:
+                raise psycopg2.OperationalError(f"Unexpected poll state {state}")
+
+            ready = loop.create_future()
+            fileno = connection.fileno()
+            add(fileno, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                remove(fileno)
@@ -0,0 +1,148 @@
+"""
+This file contains the BackgroundUploader class which sends images to a staging
+directory on CAE storage while rows are still being inserted
+"""
+import os
+import queue
+import shlex
+import threading
+import uuid
+from wa_infra_tools.database.ImageTransfer import ImageTransfer
+
+class BackgroundUploader:
+    def __init__(self, client, staging_dir, workers=4, max_retries=5, queue_size=64):
+        """
+        Constructs a BackgroundUploader object and starts its worker threads
+
+        @param client : SSHClient   - client connected to the remote machine
+        @param staging_dir : str    - remote directory that images are uploaded to before they are committed
+        @param workers : int        - number of worker threads, each leasing an SFTP session from client (default: 4)
+        @param max_retries : int    - attempts per image before the upload fails (default: 5)
+        @param queue_size : int     - maximum number of images waiting to be uploaded (default: 64)
+        """
+        self.transfer = ImageTransfer(client, workers=workers, max_retries=max_retries)
+        self.staging_dir = staging_dir if staging_dir.endswith("/") else staging_dir + "/"
+        self.transfer.make_remote_dirs([self.staging_dir])
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.staged = []    # (owner, staging path, remote filepath, remote filename) of each uploaded image
+        self.errors = []    # (owner, local filepath, exception) of each failed upload
+        self._lock = threading.Lock()
+
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, local_filepath, remote_filepath, remote_filename, owner=None):
+        """
+        Queues an image to be uploaded to the staging directory. Blocks while the queue is full
+
+        @param local_filepath : str     - path to image on local machine
+        @param remote_filepath : str    - where to store image on remote machine once committed
+        @param remote_filename : str    - what to call file on remote machine once committed
+        @param owner : any              - transaction the image belongs to, so it is only finalized/discarded with it (default: None)
+        """
+        staging_path = self.staging_dir + uuid.uuid4().hex + os.path.splitext(local_filepath)[1]
+        self.queue.put((owner, local_filepath, staging_path, remote_filepath, remote_filename))
+
+    def wait(self, owner=None):
+        """
+        Waits for every queued image to be uploaded to the staging directory
+
+        @param owner : any - only check the images of this transaction for errors (default: None, all images)
+        @raise IOError - if any image failed to upload
+        """
+        self.queue.join()
+        with self._lock:
+            errors = [(local_filepath, error) for error_owner, local_filepath, error in self.errors if owner is None or error_owner == owner]
+        if errors:
+            local_filepath, error = errors[0]
+            raise IOError(f"{len(errors)} images failed to upload (first: {local_filepath}: {error})")
+
+    def finalize(self, owner=None):
+        """
+        Waits for every queued image to be uploaded, then moves the staged images to their final location.
+        If moving fails, the images that were already moved are deleted and the rest stay staged (so that
+        discard deletes them)
+
+        @param owner : any                  - only move the images of this transaction (default: None, all images)
+        @return List[Tuple[str, str]]       - (remote filepath, remote filename) of each image moved into place
+        """
+        self.wait(owner)
+        staged = self._take(owner)
+        if not staged:
+            return []
+        try:
+            self.transfer.make_remote_dirs([remote_filepath for _, remote_filepath, _ in staged])
+            # an image that is already in place was moved by an earlier attempt that lost its connection
+            self.transfer.run_batched(
+                f"{{ mv -f {shlex.quote(staging_path)} {shlex.quote(remote_filepath + remote_filename)} || test -e {shlex.quote(remote_filepath + remote_filename)}; }}"
+                for staging_path, remote_filepath, remote_filename in staged
+            )
+        except Exception:
+            with self._lock:
+                self.staged += [(owner,) + image for image in staged]
+            try:
+                self.transfer.run_batched(
+                    f"{{ test -e {shlex.quote(staging_path)} || rm -f {shlex.quote(remote_filepath + remote_filename)}; }}"
+                    for staging_path, remote_filepath, remote_filename in staged
+                )
+            except Exception as e:
+                print(f"Failed to delete images that were moved into place: {e}")
+            raise
+        return [(remote_filepath, remote_filename) for _, remote_filepath, remote_filename in staged]
+
+    def discard(self, owner=None):
+        """
+        Waits for every queued image to be uploaded, then deletes all staged images
+
+        @param owner : any - only delete the images of this transaction (default: None, all images)
+        """
+        self.queue.join()
+        staged = self._take(owner)
+        self.transfer.run_batched(f"rm -f {shlex.quote(staging_path)}" for staging_path, _, _ in staged)
+
+    def close(self):
+        """
+        Deletes any staged images, stops the worker threads and removes the staging directory
+        """
+        self.discard()
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.transfer.close()
+        self.transfer.remove_remote_dirs([self.staging_dir])
+
+    def _work(self):
+        """
+        Worker thread loop that uploads queued images until it receives None
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                owner, local_filepath, staging_path, remote_filepath, remote_filename = item
+                try:
+                    self.transfer.put_file(local_filepath, staging_path)
+                    with self._lock:
+                        self.staged.append((owner, staging_path, remote_filepath, remote_filename))
+                except Exception as e:
+                    with self._lock:
+                        self.errors.append((owner, local_filepath, e))
+            finally:
+                self.queue.task_done()
+
+    def _take(self, owner):
+        """
+        Removes the staged images (and upload errors) of a transaction from this object
+
+        @param owner : any                  - transaction (None for all images)
+        @return List[Tuple[str, str, str]]  - (staging path, remote filepath, remote filename) of each staged image
+        """
+        with self._lock:
+            taken = [image for image in self.staged if owner is None or image[0] == owner]
+            self.staged = [image for image in self.staged if owner is not None and image[0] != owner]
+            self.errors = [error for error in self.errors if owner is not None and error[0] != owner]
+        return [image[1:] for image in taken]
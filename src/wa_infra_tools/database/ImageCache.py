@@ -0,0 +1,172 @@
+"""
+This file contains the ImageCache class which keeps a persistent local copy of
+images downloaded from CAE storage, keyed by their remote filepath
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from wa_infra_tools import file_utils
+
+def default_cache_dir():
+    """
+    Gets the default location of the image cache (~/.cache/wa_infra_tools/images or under XDG_CACHE_HOME)
+    """
+    return file_utils.cache_dir("images")
+
+def file_sha256(filepath, chunk_size=1 << 20):
+    """
+    Computes the sha256 hash of a file
+
+    @param filepath : str   - path to the file
+    @param chunk_size : int - number of bytes read at once (default: 1 MiB)
+    @return str             - hex digest of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class ImageCache:
+    def __init__(self, cache_dir=None, max_bytes=50e9, verify=True):
+        """
+        Constructs an ImageCache object, creating the cache directory and its index if needed
+
+        @param cache_dir : str  - where cached images are stored (default: ~/.cache/wa_infra_tools/images)
+        @param max_bytes : int  - size of the cache, least recently used images are evicted past it (default: 50 GB)
+        @param verify : bool    - check the sha256 hash of cached images before using them (default: True)
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.verify = verify
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(os.path.join(self.cache_dir, "index.db"), check_same_thread=False)
+        self._index.execute(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                remote_path TEXT PRIMARY KEY,
+                size INTEGER,
+                sha256 TEXT,
+                last_used REAL
+            )
+            """)
+        self._index.execute("CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used)")
+        self._index.commit()
+        self.total_bytes = self._index.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+    def fetch(self, remote_path, local_filepath, sha256=None):
+        """
+        Links the cached copy of a remote image to local_filepath. Copies that are missing, fail
+        the integrity check or do not have the expected hash are dropped from the cache
+
+        @param remote_path : str    - path to the image on the remote machine
+        @param local_filepath : str - where the image should appear on the local machine
+        @param sha256 : str         - expected hash of the image (default: None, any version of the image)
+        @return int                 - size of the image (None if it is not cached)
+        """
+        with self._lock:
+            entry = self._index.execute("SELECT size, sha256 FROM images WHERE remote_path = ?", (remote_path,)).fetchone()
+        if entry is None:
+            return None
+
+        size, cached_sha256 = entry
+        cache_path = self._cache_path(remote_path)
+        if (
+            (sha256 is not None and cached_sha256 != sha256)
+            or not os.path.isfile(cache_path)
+            or os.path.getsize(cache_path) != size
+            or (self.verify and file_sha256(cache_path) != cached_sha256)
+        ):
+            self.remove(remote_path)
+            return None
+
+        # the cached copy is shared with every download it is linked into, hardlinks are made read-only
+        file_utils.link_or_copy(cache_path, local_filepath, protect=True)
+        with self._lock:
+            self._index.execute("UPDATE images SET last_used = ? WHERE remote_path = ?", (time.time(), remote_path))
+            self._index.commit()
+        return size
+
+    def add(self, remote_path, local_filepath, sha256=None):
+        """
+        Adds a downloaded image to the cache, then evicts the least recently used images
+        until the cache fits in max_bytes
+
+        @param remote_path : str    - path to the image on the remote machine
+        @param local_filepath : str - where the image was downloaded to
+        @param sha256 : str         - hash of the image if it is already known (default: None, computed here)
+        """
+        size = os.path.getsize(local_filepath)
+        if size > self.max_bytes:
+            return
+        if sha256 is None:
+            sha256 = file_sha256(local_filepath)
+
+        cache_path = self._cache_path(remote_path)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        file_utils.link_or_copy(local_filepath, cache_path, protect=True)
+
+        with self._lock:
+            old = self._index.execute("SELECT size FROM images WHERE remote_path = ?", (remote_path,)).fetchone()
+            self._index.execute(
+                "INSERT OR REPLACE INTO images (remote_path, size, sha256, last_used) VALUES (?, ?, ?, ?)",
+                (remote_path, size, sha256, time.time())
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self._index.commit()
+        self._evict()
+
+    def remove(self, remote_path):
+        """
+        Drops an image from the cache
+
+        @param remote_path : str - path to the image on the remote machine
+        """
+        with self._lock:
+            self._remove(remote_path)
+            self._index.commit()
+
+    def clear(self):
+        """
+        Drops every image from the cache
+        """
+        with self._lock:
+            for (remote_path,) in self._index.execute("SELECT remote_path FROM images").fetchall():
+                self._remove(remote_path)
+            self._index.commit()
+
+    def _evict(self):
+        """
+        Drops the least recently used images until the cache fits in max_bytes
+        """
+        with self._lock:
+            while self.total_bytes > self.max_bytes:
+                entry = self._index.execute("SELECT remote_path FROM images ORDER BY last_used LIMIT 1").fetchone()
+                if entry is None:
+                    break
+                self._remove(entry[0])
+            self._index.commit()
+
+    def _remove(self, remote_path):
+        """
+        Drops an image from the cache without committing the index (the lock must be held)
+        """
+        entry = self._index.execute("SELECT size FROM images WHERE remote_path = ?", (remote_path,)).fetchone()
+        if entry is None:
+            return
+        self._index.execute("DELETE FROM images WHERE remote_path = ?", (remote_path,))
+        self.total_bytes -= entry[0]
+        cache_path = self._cache_path(remote_path)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def _cache_path(self, remote_path):
+        """
+        Gets where the cached copy of a remote image is stored
+        """
+        key = hashlib.sha256(remote_path.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key[2:])
@@ -0,0 +1,328 @@
+"""
+This file contains the ImageTransfer class which moves images between this
+machine and CAE storage over several pooled SFTP sessions at once
+"""
+import hashlib
+import os
+import paramiko
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from wa_infra_tools.database.ImageCache import file_sha256
+from wa_infra_tools.ssh_utils.SSHClient import RemoteCommandError
+
+class ChecksumError(IOError):
+    """
+    Raised when a downloaded file does not match the size or hash recorded for it
+    """
+    pass
+
+# errors that will not go away by retrying the transfer
+PERMANENT_ERRORS = (FileNotFoundError, PermissionError, RemoteCommandError)
+
+class ImageTransfer:
+    def __init__(self, client, workers=8, max_retries=5, backoff=0.5):
+        """
+        Constructs an ImageTransfer object that leases its SFTP sessions from the pool of client
+
+        @param client : SSHClient   - client connected to the remote machine
+        @param workers : int        - number of files transferred at once, at most the sftp_sessions of client
+                                      run at the same time (default: 8)
+        @param max_retries : int    - attempts per file before giving up (default: 5)
+        @param backoff : float      - seconds to wait before the first retry, doubled after every retry (default: 0.5)
+        """
+        self.client = client
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def upload(self, items):
+        """
+        Uploads files to the remote machine. Every distinct remote directory is created
+        once before any file is sent
+
+        @param items : List[Tuple[str, str, str]]   - (local filepath, remote filepath, remote filename) of each file
+        @return Dict[str, float]                    - number of files and bytes sent, seconds taken and MB/s
+        """
+        self.make_remote_dirs([remote_filepath for _, remote_filepath, _ in items])
+
+        start_time = time.time()
+        num_bytes = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = [
+                executor.submit(self.put_file, local_filepath, remote_filepath + remote_filename)
+                for local_filepath, remote_filepath, remote_filename in items
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                num_bytes += future.result()
+        return self._report("Uploaded", len(items), num_bytes, time.time() - start_time)
+
+    def download(self, items, total=None, cache=None, manifest=None, on_done=None):
+        """
+        Downloads files from the remote machine. Items are consumed lazily (at most a few per
+        worker are in flight) and progress is reported in the order of items. Files are hashed while
+        they are received; files with a known checksum are verified (and downloaded again if they do
+        not match), and are not downloaded at all if the local copy already matches
+
+        @param items : Iterable[Tuple[str, str]]    - (remote path, local filepath) of each file, optionally followed by
+                                                      its checksum as a (size, sha256) tuple (either may be None)
+        @param total : int                          - number of items, for the progress bar (default: len(items) if available)
+        @param cache : ImageCache                   - cache that files are linked from instead of downloaded when
+                                                      possible, and that downloaded files are added to (default: None)
+        @param manifest : SyncManifest              - manifest of files already downloaded; files that are unchanged on the
+                                                      remote machine are skipped and partial files are resumed (default: None)
+        @param on_done : Callable[[str, str], None] - called with (remote path, local filepath) of each file once it is
+                                                      downloaded, in the order of items (default: None)
+        @return Dict[str, float]                    - number of files and bytes received, seconds taken and MB/s
+        """
+        if total is None and hasattr(items, "__len__"):
+            total = len(items)
+
+        start_time = time.time()
+        num_bytes = 0
+        sources = {"remote": 0, "cache": 0, "local": 0}
+
+        def finish(future, remote_path, local_filepath):
+            nonlocal num_bytes
+            file_bytes, source = future.result()
+            if on_done is not None:
+                on_done(remote_path, local_filepath)
+            sources[source] += 1
+            if source == "remote":
+                num_bytes += file_bytes
+            progress.update()
+            if manifest is not None and progress.n % 1000 == 0:
+                manifest.save()
+
+        try:
+            with ThreadPoolExecutor(self.workers) as executor, tqdm(total=total) as progress:
+                in_flight = deque()
+                for item in items:
+                    remote_path, local_filepath = item[:2]
+                    checksum = item[2] if len(item) > 2 else None
+                    future = executor.submit(self._fetch, remote_path, local_filepath, cache, manifest, checksum)
+                    in_flight.append((future, remote_path, local_filepath))
+                    if len(in_flight) >= 4 * self.workers:
+                        finish(*in_flight.popleft())
+                while in_flight:
+                    finish(*in_flight.popleft())
+        finally:
+            if manifest is not None:
+                manifest.save()
+        if cache is not None:
+            print(f"Linked {sources['cache']} files from the cache")
+        if manifest is not None or sources["local"]:
+            print(f"Skipped {sources['local']} files that were already up to date")
+        return self._report("Downloaded", sources["remote"], num_bytes, time.time() - start_time)
+
+    def make_remote_dirs(self, remote_dirs):
+        """
+        Creates directories on the remote machine in one round trip (see SSHClient.make_dirs),
+        retrying if the connection fails
+
+        @param remote_dirs : Iterable[str] - directories to create (parents are created as needed)
+        """
+        self._retry(self.client.make_dirs, list(remote_dirs))
+
+    def remove_remote_dirs(self, remote_dirs):
+        """
+        Removes empty directories on the remote machine in one round trip, retrying if the connection fails
+
+        @param remote_dirs : Iterable[str] - directories to remove
+        """
+        self._retry(self.client.remove_dirs, list(remote_dirs))
+
+    def run_batched(self, commands):
+        """
+        Runs many commands on the remote machine in one shell (see SSHClient.run_batched). Stops at the
+        first command that fails. Commands must be safe to repeat, they are run again if the connection is lost
+
+        @param commands : Iterable[str] - shell commands to run in order
+        """
+        self._retry(self.client.run_batched, list(commands))
+
+    def put_file(self, local_filepath, remote_path):
+        """
+        Sends one file to the remote machine on a pooled SFTP session, retrying on transfer errors
+
+        @param local_filepath : str - path to the file on the local machine
+        @param remote_path : str    - where to store the file on the remote machine
+        @return int                 - number of bytes sent
+        """
+        return self._retry(self._put, local_filepath, remote_path)
+
+    def get_file(self, remote_path, local_filepath):
+        """
+        Receives one file from the remote machine on a pooled SFTP session, retrying on transfer errors
+
+        @param remote_path : str    - path to the file on the remote machine
+        @param local_filepath : str - where to store the file on the local machine
+        @return int                 - number of bytes received
+        """
+        return self._retry(self._get, remote_path, local_filepath)[0]
+
+    def close(self):
+        """
+        Closes the idle SFTP sessions of the pool of the client (they are reopened when needed)
+        """
+        self.client.close_sftp_sessions()
+
+    def _put(self, local_filepath, remote_path):
+        """
+        Sends one file to the remote machine
+
+        @param local_filepath : str - path to the file on the local machine
+        @param remote_path : str    - where to store the file on the remote machine
+        @return int                 - number of bytes sent
+        """
+        with self.client.sftp() as sftp:
+            return sftp.put(local_filepath, remote_path).st_size
+
+    def _fetch(self, remote_path, local_filepath, cache, manifest, checksum=None):
+        """
+        Gets one file from the local copy (if it matches its checksum or is listed in the manifest),
+        the cache, or the remote machine
+
+        @param remote_path : str        - path to the file on the remote machine
+        @param local_filepath : str     - where to store the file on the local machine
+        @param cache : ImageCache       - cache to use (None to not use a cache)
+        @param manifest : SyncManifest  - manifest to check and update (None to always replace local files)
+        @param checksum : Tuple[int, str] - expected size and sha256 hash of the file (default: None, not verified)
+        @return Tuple[int, str]         - size of the file and where it came from ("local", "cache" or "remote")
+        """
+        # the remote size and mtime are always recorded in the manifest, so later syncs without checksums can use it
+        attrs = self._retry(self._stat, remote_path) if manifest is not None else None
+
+        size, sha256 = checksum or (None, None)
+        if sha256 is not None and os.path.isfile(local_filepath) and self._matches(local_filepath, size, sha256):
+            if manifest is not None:
+                manifest.update(local_filepath, remote_path, attrs, sha256)
+            return os.path.getsize(local_filepath), "local"
+
+        if manifest is not None and manifest.is_current(local_filepath, remote_path, attrs):
+            return attrs.st_size, "local"
+
+        num_bytes = cache.fetch(remote_path, local_filepath, sha256) if cache is not None else None
+        if num_bytes is not None:
+            source = "cache"
+        else:
+            num_bytes, sha256 = self._retry(self._get, remote_path, local_filepath, checksum, attrs)
+            source = "remote"
+
+        if source == "remote" and cache is not None:
+            cache.add(remote_path, local_filepath, sha256)
+        if manifest is not None:
+            manifest.update(local_filepath, remote_path, attrs, sha256)
+        return num_bytes, source
+
+    def _stat(self, remote_path):
+        """
+        Gets the attributes of a file on the remote machine
+
+        @param remote_path : str    - path to the file on the remote machine
+        @return SFTPAttributes      - attributes of the file
+        """
+        with self.client.sftp() as sftp:
+            return sftp.stat(remote_path)
+
+    def _get(self, remote_path, local_filepath, checksum=None, attrs=None):
+        """
+        Receives one file from the remote machine into local_filepath.part, hashing it as it is written, then
+        renames it to local_filepath. With attrs, an interrupted earlier download in the .part file is continued,
+        as long as the remote file still has the size and mtime recorded next to it (in local_filepath.part.source)
+
+        @param remote_path : str            - path to the file on the remote machine
+        @param local_filepath : str         - where to store the file on the local machine
+        @param checksum : Tuple[int, str]   - expected size and sha256 hash of the file (default: None, not verified)
+        @param attrs : SFTPAttributes       - attributes of the remote file, to resume from (default: None, start over)
+        @return Tuple[int, str]             - number of bytes received and sha256 hash of the file
+        """
+        part_filepath = local_filepath + ".part"
+        source_filepath = part_filepath + ".source"
+        source = f"{attrs.st_size} {attrs.st_mtime}" if attrs is not None else None
+        sha = hashlib.sha256()
+        offset = 0
+        if (
+            source is not None
+            and os.path.isfile(part_filepath)
+            and os.path.getsize(part_filepath) <= attrs.st_size
+            and self._read_source(source_filepath) == source
+        ):
+            with open(part_filepath, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(chunk)
+                    offset += len(chunk)
+        elif source is not None:
+            # written before any data so that a .part file is never resumed against a different version of the file
+            with open(source_filepath, "w") as f:
+                f.write(source)
+        elif os.path.exists(source_filepath):
+            os.remove(source_filepath)
+
+        with self.client.sftp() as sftp, sftp.open(remote_path, "rb") as remote_file, open(part_filepath, "ab" if offset else "wb") as f:
+            remote_file.seek(offset)
+            # prefetch takes the size of the whole file and requests everything after the current position
+            remote_file.prefetch(attrs.st_size if attrs is not None else None)
+            for chunk in iter(lambda: remote_file.read(1 << 20), b""):
+                sha.update(chunk)
+                f.write(chunk)
+
+        file_size = os.path.getsize(part_filepath)
+        if attrs is not None and file_size != attrs.st_size:
+            raise IOError(f"Size of {local_filepath} does not match {remote_path}")
+        size, sha256 = checksum or (None, None)
+        if (size is not None and file_size != size) or (sha256 is not None and sha.hexdigest() != sha256):
+            os.remove(part_filepath)
+            raise ChecksumError(f"{remote_path} does not match its checksum")
+        os.replace(part_filepath, local_filepath)
+        if os.path.exists(source_filepath):
+            os.remove(source_filepath)
+        return file_size - offset, sha.hexdigest()
+
+    def _retry(self, func, *args):
+        """
+        Calls func, retrying with exponential backoff on transfer errors. The session that failed is not
+        reused (see SSHClient.sftp), and the SSH connection is re-established if it was lost
+
+        @param func : Callable  - transfer function to call
+        @param args : any       - arguments to func
+        @return any             - result of func
+        """
+        for attempt in range(self.max_retries):
+            try:
+                return func(*args)
+            except PERMANENT_ERRORS:
+                raise
+            except (OSError, EOFError, paramiko.SSHException):
+                if attempt == self.max_retries - 1:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                self.client.ensure_connected()
+
+    @staticmethod
+    def _read_source(source_filepath):
+        """
+        Reads the size and mtime of the remote file that a .part file was received from ("<size> <mtime>", None if unknown)
+        """
+        if not os.path.isfile(source_filepath):
+            return None
+        with open(source_filepath) as f:
+            return f.read()
+
+    @staticmethod
+    def _matches(local_filepath, size, sha256):
+        """
+        Checks a local file against its expected size and sha256 hash
+        """
+        return (size is None or os.path.getsize(local_filepath) == size) and file_sha256(local_filepath) == sha256
+
+    @staticmethod
+    def _report(action, num_files, num_bytes, seconds):
+        """
+        Prints and returns throughput statistics of a transfer
+        """
+        seconds = max(seconds, 1e-6)
+        mb_per_sec = num_bytes / 1e6 / seconds
+        print(f"{action} {num_files} files ({num_bytes / 1e6:.1f} MB) in {seconds:.1f}s ({mb_per_sec:.2f} MB/s)")
+        return {"files": num_files, "bytes": num_bytes, "seconds": seconds, "mb_per_sec": mb_per_sec}
@@ -3,15 +3,44 @@ This file contains the PostgresDatabase class which connects the
 user to the database on CAE storage
 """
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import contextlib
+import io
+import itertools
 import os
+import re
+import shlex
+import threading
 import time
 import hashlib
-from tqdm import tqdm 
-from collections import defaultdict
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from wa_infra_tools.ssh_utils.SSHClient import SSHClient
+from wa_infra_tools.database.ImageTransfer import ImageTransfer
+from wa_infra_tools.database.BackgroundUploader import BackgroundUploader
+from wa_infra_tools.database.SyncManifest import SyncManifest
+from wa_infra_tools.database.ImageCache import file_sha256
+from wa_infra_tools.database.queries import dataset_query
+from wa_infra_tools.database.exporters import EXPORTERS
+from wa_infra_tools.database.labels import label_columns, format_labels
+
+# where images inserted into the database are stored on CAE storage
+CAE_ROOT = "/groupspace/studentorgs/wiautonomous/pgsql/"
+
+# columns of an image table that, when present, hold the sha256 hash and size in bytes of each image
+CHECKSUM_COLUMN = "checksum"
+FILE_SIZE_COLUMN = "file_size"
+
+# number of image ids reserved from a table's sequence at once
+ID_BLOCK_SIZE = 1000
+
+# statements that can change which tables/columns exist (SELECT ... INTO creates a table)
+DDL_PATTERN = re.compile(r"\b(CREATE|DROP|ALTER)\b|\bSELECT\b[^;]*\bINTO\b", re.IGNORECASE)
 
 class PostgresDatabase:
-    def __init__(self, cae_username, hostname, dbname='wa', db_username='wa_admin', db_password='wa', local_port=1234, remote_port=5432):
+    def __init__(self, cae_username, hostname, dbname='wa', db_username='wa_admin', db_password='wa', local_port=1234, remote_port=5432, transfer_workers=8, transfer_retries=5, async_upload=False, upload_queue_size=64, image_cache=None, dedup=False, pool_size=None, keepalive=30):
         """
         Constructs a PostgresDatabase object by setting up SSH tunnel
         Note: the database runs on tux-133.cae.wisc.edu so hostname must be that machine (for now)
@@ -23,43 +52,278 @@ class PostgresDatabase:
         @param hostname : str       - ip address or alias of host (default: tux-133.cae.wisc.edu)
         @param local_port : int     - port to use for tunneling on this machine (default: 1234)
         @param remote_port : int    - port of the database on the remote machine (default: 5432)
+        @param transfer_workers : int - number of pooled SFTP sessions used to send and receive images (default: 8)
+        @param transfer_retries : int - attempts per image before a transfer fails (default: 5)
+        @param async_upload : bool  - upload images to a staging directory in the background as soon as they are
+                                      inserted, commit then only moves them into place (default: False)
+        @param upload_queue_size : int - maximum number of images waiting to be uploaded in the background (default: 64)
+        @param image_cache : ImageCache - local cache that downloaded images are linked from and added to (default: None)
+        @param dedup : bool         - don't store images whose content is already in the table, rows of duplicates point to the
+                                      existing image instead. Tables need a checksum column, images are uploaded on commit (default: False)
+        @param pool_size : int      - open a pool of up to this many connections over the tunnel so that several threads can
+                                      use this object at once, each thread gets its own connection and transaction (default: None,
+                                      a single connection)
+        @param keepalive : int      - seconds between SSH keepalives and connection probes, a lost connection is re-established
+                                      in the background (default: 30, None to disable)
         """
-        self.client = SSHClient(username=cae_username, hostname=hostname)
+        self.client = SSHClient(username=cae_username, hostname=hostname, keepalive=keepalive or 0, monitor_interval=keepalive, sftp_sessions=transfer_workers)
         self.client.start_tunnel(local_port=local_port, remote_host='localhost', remote_port=remote_port)
+        self.transfer = ImageTransfer(self.client, workers=transfer_workers, max_retries=transfer_retries)
+        self.image_cache = image_cache
+        self.uploader = None
+        self.dedup = dedup
+        if async_upload and not dedup:
+            self.uploader = BackgroundUploader(
+                self.client,
+                CAE_ROOT + ".staging/" + uuid.uuid4().hex,
+                workers=transfer_workers,
+                max_retries=transfer_retries,
+                queue_size=upload_queue_size
+            )
 
-        self.uncomitted_image_paths = []
+        # connection, cursor and uncommitted images of each thread (in pooled mode)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # cache of table name -> schema, filled on first use and cleared by DDL, and the (table, column) of
+        # every GENERATED ALWAYS identity column (filled with it)
+        self._catalog = None
+        self._always_identity = set()
+        self.catalog_hits = 0
+        self.catalog_misses = 0
+
+        # image ids reserved from the sequence of each (table, id column)
+        self._id_blocks = {}
+
+        # used to give server-side cursors unique names
+        self._cursor_ids = itertools.count(1)
+
+        # hashes the images of multi-row inserts in parallel (its threads are only started when first needed)
+        self._hash_executor = ThreadPoolExecutor(transfer_workers)
 
         conn_string = "host='localhost' port='{}' dbname='{}' user='{}' password='{}'".format(local_port, dbname, db_username, db_password)
         print("Connecting to", conn_string)
+        self.conn_string = conn_string
+        self.pool = None
+        self._connection = None
         try:
-            self.connection = psycopg2.connect(conn_string)
-            self.cursor = self.connection.cursor() 
+            if pool_size is None:
+                self._connection = psycopg2.connect(conn_string)
+                self._cursor = self._connection.cursor() 
+            else:
+                # every connection of the pool goes through the same tunnel (and 2FA session)
+                self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, conn_string)
+                self._pool_slots = threading.BoundedSemaphore(pool_size)
+                # the pool is replaced whenever the SSH connection (and the tunnel under its connections) is re-established
+                self._pool_lock = threading.Lock()
+                self._pool_reconnects = self.client.reconnects
         except:
             print("Failed to connect")
             self.client.stop_tunnels()
 
+    @property
+    def connection(self):
+        """
+        Connection of the calling thread. In pooled mode a connection is leased from the pool (waiting
+        for one to be free) and held by the thread until its transaction is committed or rolled back
+        """
+        if self.pool is None:
+            return self._connection
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self._pool_slots.acquire()
+            pool = self.pool
+            try:
+                connection = pool.getconn()
+            except Exception:
+                self._pool_slots.release()
+                raise
+            self._local.connection = connection
+            self._local.pool = pool
+            self._local.cursor = connection.cursor()
+        return connection
+
+    @property
+    def cursor(self):
+        """
+        Cursor on the connection of the calling thread
+        """
+        if self.pool is None:
+            return self._cursor
+        self.connection
+        return self._local.cursor
+
+    @property
+    def uncomitted_image_paths(self):
+        """
+        (local filepath, remote filepath, remote filename) of the images inserted by the calling thread since its last commit
+        """
+        if not hasattr(self._local, "image_paths"):
+            self._local.image_paths = []
+        return self._local.image_paths
+
+    @uncomitted_image_paths.setter
+    def uncomitted_image_paths(self, image_paths):
+        self._local.image_paths = image_paths
+
+    @property
+    def _dedup_images(self):
+        """
+        (table name, checksum, local filepath, remote filepath, remote filename) of images inserted by the calling thread in dedup mode
+        """
+        if not hasattr(self._local, "dedup_images"):
+            self._local.dedup_images = []
+        return self._local.dedup_images
+
+    @_dedup_images.setter
+    def _dedup_images(self, images):
+        self._local.dedup_images = images
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager that commits everything done inside it by the calling thread (including sending
+        images) when it exits, or rolls it back if an exception is raised, also by the commit itself (so the
+        connection always goes back to the pool). Each thread has its own transaction, so worker threads can
+        each use one at the same time in pooled mode
+
+        @return cursor - cursor of the calling thread
+        """
+        try:
+            yield self.cursor
+            self.commit()
+        except BaseException:
+            self.rollback()
+            raise
+
     def sql(self, sql_string):
         """
-        Executes any sql command on the database
+        Executes any sql command on the database. Commands that create, drop or alter
+        tables invalidate the cached catalog. If the connection to the database was lost it is
+        re-established, and the command is run again if no transaction was in progress
 
         @param sql_string : str     - string containing sql command
         @return List[Tuple[any...]] - list of the result of the query (if there is a response)
         """
-        self.cursor.execute(sql_string)
+        idle = not self.connection.closed and self.connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            self.cursor.execute(sql_string)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if not self.connection.closed:
+                raise
+            self.reconnect()
+            if not idle: # the uncommitted changes were lost with the connection
+                raise
+            try:
+                self.cursor.execute(sql_string)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # the new connection is not kept if it failed as well
+                self.rollback()
+                raise
+        if DDL_PATTERN.search(sql_string):
+            self._catalog = None
+            self._id_blocks = {}
         return self.cursor.fetchall() if self.cursor.pgresult_ptr is not None else []
 
+    def iter_sql(self, sql_string, batch_size=1000, params=None):
+        """
+        Executes a query with a server-side cursor and yields the resulting rows as they arrive,
+        fetching batch_size rows at a time so memory use stays bounded for large results
+
+        @param sql_string : str     - string containing sql query
+        @param batch_size : int     - number of rows fetched from the database at once (default: 1000)
+        @param params : List[any]   - values substituted for %s placeholders in sql_string (default: None)
+        @return Iterator[Tuple[any...]] - rows of the result of the query
+        """
+        _, batches = self._iter_batches(sql_string, batch_size, params)
+        for batch in batches:
+            yield from batch
+
     def commit(self):
         """
         Commits transaction on the sql database AND sends all images that were inserted into
-        the database to the remote machine
-        """
-        self.connection.commit()
-        if self.uncomitted_image_paths:
-            print("Uploading images")
-            for i in tqdm(range(len(self.uncomitted_image_paths))):
-                local_filepath, remote_filepath, remote_filename  = self.uncomitted_image_paths[i]
-                self._upload_image(local_filepath, remote_filepath, remote_filename)
+        the database to the remote machine. With async_upload, the images have already been sent
+        to a staging directory so they are only moved into place. With dedup, images whose content
+        is already stored are looked up with one query per table and are not sent. Images are put in
+        place before the transaction is committed: nothing is committed if any image failed to upload,
+        and the images are deleted again if the commit itself fails
+        """
+        if self._dedup_images:
+            self.uncomitted_image_paths += self._deduplicate()
+            self._dedup_images = []
+        if self.uploader is not None:
+            image_paths = self.uploader.finalize(self._owner())
+        else:
+            image_paths = [(remote_filepath, remote_filename) for _, remote_filepath, remote_filename in self.uncomitted_image_paths]
+            if image_paths:
+                print("Uploading images")
+                try:
+                    self.transfer.upload(self.uncomitted_image_paths)
+                except Exception:
+                    self._remove_remote_images(image_paths)
+                    raise
+        try:
+            self.connection.commit()
+        except Exception:
+            self._remove_remote_images(image_paths)
+            raise
+        self._release()
+        self.uncomitted_image_paths = []
+
+    def rollback(self):
+        """
+        Rolls back the transaction on the sql database and drops all images that were inserted
+        since the last commit (deleting them from the staging directory with async_upload)
+        """
+        broken = False
+        try:
+            self.connection.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the connection is unusable (e.g. the tunnel was lost), nothing is left to roll back on it
+            broken = True
+        self._release(close=broken)
+        self._catalog = None
+        self.uncomitted_image_paths = []
+        self._dedup_images = []
+        if self.uploader is not None:
+            self.uploader.discard(self._owner())
+
+    def close(self):
+        """
+        Rolls back any uncommitted changes, closes the connection to the database (every connection of
+        the pool in pooled mode) and stops the tunnels
+        """
+        self.rollback()
+        if self.uploader is not None:
+            self.uploader.close()
+        if self.pool is None:
+            self._connection.close()
+        else:
+            self.pool.closeall()
+        self._hash_executor.shutdown()
+        self.client.close()
+
+    def reconnect(self):
+        """
+        Re-establishes the SSH connection (if it was lost) and the database connection of the calling
+        thread. In pooled mode, the pool is replaced if the SSH connection was re-established, as every
+        connection in it went through the lost tunnel. Anything not yet committed on the old connection
+        is lost, so the images inserted since the last commit are dropped
+        """
+        self.client.ensure_connected(probe=True)
+        if self.pool is None:
+            self._connection.close()
+            self._connection = psycopg2.connect(self.conn_string)
+            self._cursor = self._connection.cursor()
+        else:
+            self._release(close=True)
+            self._replace_pool()
+
+        if self.uploader is not None:
+            self.uploader.discard(self._owner())
         self.uncomitted_image_paths = []
+        self._dedup_images = []
+        print("Reconnected to the database")
 
     def get_schema(self, table_name):
         """
@@ -67,13 +331,48 @@ class PostgresDatabase:
 
         @param table_name : str - table name 
         """
-        assert table_name in self.tables, f"Table {table_name} is not in the database"
-        return self.sql(
-            f"""
-            SELECT column_name, data_type, character_maximum_length
-                FROM information_schema.columns
-                WHERE table_name = '{table_name}'
+        catalog = self._get_catalog()
+        assert table_name in catalog, f"Table {table_name} is not in the database"
+        return list(catalog[table_name])
+
+    def refresh_catalog(self):
+        """
+        Reloads the names and schemas of all tables in the database with a single query.
+        Called automatically when the catalog is first needed or after DDL is executed
+        through sql(), call it manually if tables are changed by another connection
+        """
+        records = self.sql(
+            """
+            SELECT t.table_name, c.column_name, c.data_type, c.character_maximum_length, c.identity_generation
+                FROM information_schema.tables t
+                LEFT JOIN information_schema.columns c
+                    ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+                WHERE t.table_schema = 'public'
+                ORDER BY t.table_name, c.ordinal_position
             """)
+        catalog = {}
+        always_identity = set()
+        for table_name, column_name, data_type, max_length, identity_generation in records:
+            columns = catalog.setdefault(table_name, [])
+            if column_name is not None:
+                columns.append((column_name, data_type, max_length))
+            if identity_generation == "ALWAYS":
+                always_identity.add((table_name, column_name))
+        self._always_identity = always_identity
+        self._catalog = catalog
+
+    def _get_catalog(self):
+        """
+        Returns the cached catalog, loading it if needed
+
+        @return Dict[str, List[Tuple[str, str, int]]] - maps table names to their schema
+        """
+        if self._catalog is None:
+            self.catalog_misses += 1
+            self.refresh_catalog()
+        else:
+            self.catalog_hits += 1
+        return self._catalog
 
     def preview_table(self, table_name, limit=10):
         """
@@ -82,7 +381,7 @@ class PostgresDatabase:
         @param table_name : str - table name 
         @param limit : int      - number of rows to be shown (default: 10)
         """
-        assert table_name in self.tables, f"Table {table_name} is not in the database"
+        assert table_name in self._get_catalog(), f"Table {table_name} is not in the database"
         return self.sql(
             f"""
             SELECT * 
@@ -90,7 +389,7 @@ class PostgresDatabase:
                 LIMIT {limit}
             """)
 
-    def insert_row(self, table_name, value_dict):
+    def insert_row(self, table_name, value_dict, returning=None):
         """
         Insert row into the database. Does not commit the insertion into the database until commit is called
         Note: This function will NOT prepare to send any images you want to insert
@@ -98,6 +397,8 @@ class PostgresDatabase:
 
         @param table_name : str             - table to insert into
         @param value_dict : Dict[str, any]  - dictionary of column name, value pairs to insert
+        @param returning : str              - column of the inserted row to return (default: None)
+        @return any                         - value of the returning column (if returning is given)
         """
         self._check_schema(table_name, value_dict)
         col_names = []
@@ -106,150 +407,421 @@ class PostgresDatabase:
             col_names.append(name)
             col_values.append(str(val))
 
-        self.sql(
+        records = self.sql(
             """
-            INSERT INTO {} ({})
+            INSERT INTO {} ({}) {}
             VALUES ({})
+            {}
             """.format(
                 table_name,
                 ", ".join(col_names),
-                ", ".join(col_values)
+                self._overriding(table_name, col_names),
+                ", ".join(col_values),
+                f"RETURNING {returning}" if returning is not None else ""
             )
         )
+        if returning is not None:
+            return records[0][0]
+
+    def insert_rows(self, table_name, rows, batch_size=10000, use_copy=True):
+        """
+        Insert many rows into the database. Does not commit the insertion into the database until commit is called
+        Note: unlike insert_row, values are plain python values (strings should NOT be wrapped in '')
+
+        @param table_name : str                     - table to insert into
+        @param rows : List[Dict[str, any]]          - list of dictionaries of column name, value pairs to insert
+        @param batch_size : int                     - number of rows sent to the database at once (default: 10000)
+        @param use_copy : bool                      - use COPY FROM STDIN, otherwise batched INSERTs (default: True)
+        @return int                                 - number of rows inserted
+        """
+        return self.bulk_load(table_name, rows, batch_size, use_copy)
+
+    def bulk_load(self, table_name, iterable, batch_size=10000, use_copy=True):
+        """
+        Streams rows from any iterable into a table in batches using COPY FROM STDIN (or batched
+        INSERTs with execute_values if use_copy is False). The schema is checked once per batch.
+        Does not commit the insertion into the database until commit is called
+
+        @param table_name : str                     - table to insert into
+        @param iterable : Iterable[Dict[str, any]]  - dictionaries of column name, value pairs to insert
+        @param batch_size : int                     - number of rows sent to the database at once (default: 10000)
+        @param use_copy : bool                      - use COPY FROM STDIN, otherwise batched INSERTs (default: True)
+        @return int                                 - number of rows inserted
+        """
+        start_time = time.time()
+        num_rows = 0
+        batch = []
+        for value_dict in iterable:
+            batch.append(value_dict)
+            if len(batch) >= batch_size:
+                num_rows += self._load_batch(table_name, batch, use_copy)
+                batch = []
+        if batch:
+            num_rows += self._load_batch(table_name, batch, use_copy)
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        print(f"Inserted {num_rows} rows into {table_name} ({num_rows / elapsed:.0f} rows/sec)")
+        return num_rows
 
     def insert_row_with_image(self, table_name, value_dict, image_id_col="image_id"):
         """
         Insert row into the database with image. Does not commit the insertion into the database or send the 
-        image until commit is called
+        image until commit is called. The image id is taken from a block of ids reserved from the table's
+        sequence, so the row (with its final filepath) is inserted with a single statement. If the table has
+        checksum/file_size columns, the hash and size of the image are recorded in them
 
         @param table_name : str             - table to insert into
         @param value_dict : Dict[str, any]  - dictionary of column name, value pairs to insert
         @param image_id_col: str            - name of the id (primary key) column in the table (default: image_id)
+        @return int                         - image id of the inserted row
         """
         assert "filepath" in value_dict, "The values you insert must contain a filepath attribute with the local filepath of the image"
 
         # get local filepath from values
         local_filepath = value_dict["filepath"]
         assert os.path.isfile(local_filepath), f"The path {local_filepath} to the image is invalid"
+        checksum = self._checksums(table_name, [local_filepath])[0]
+        for name, val in checksum.items():
+            value_dict[name] = f"'{val}'" if name == CHECKSUM_COLUMN else val
 
-        # insert row without filepath
-        value_dict["filepath"] = "'temp'"
-        self.insert_row(table_name, value_dict)
+        ids = self._reserve_ids(table_name, image_id_col, 1)
+        if ids is not None:
+            # insert row with its id and final filepath
+            image_id = ids[0]
+            cae_filepath, cae_filename = self._cae_path(table_name, image_id, local_filepath)
+            value_dict[image_id_col] = image_id
+            value_dict["filepath"] = f"'{cae_filepath}{cae_filename}'"
+            self.insert_row(table_name, value_dict)
+        else:
+            # the id column has no sequence, let the database pick the id and then set the filepath
+            value_dict["filepath"] = "'temp'"
+            image_id = self.insert_row(table_name, value_dict, returning=image_id_col)
+            cae_filepath, cae_filename = self._cae_path(table_name, image_id, local_filepath)
+            self.sql(f"UPDATE {table_name} SET filepath = '{cae_filepath}{cae_filename}' WHERE {image_id_col} = {image_id}")
 
-        # get image_id of the row
-        image_id = self.sql(f"SELECT max({image_id_col}) FROM {table_name}")[0][0] or 0
-        hash_val = str(hashlib.md5(repr(image_id).encode()).hexdigest())
+        self._queue_upload(local_filepath, cae_filepath, cae_filename, table_name, checksum.get(CHECKSUM_COLUMN))
+        return image_id 
 
-        # generate filepath for the image to be stored
-        image_extension = "." + local_filepath.split(".")[-1]
-        cae_filepath = f"/groupspace/studentorgs/wiautonomous/pgsql/{table_name}/"
-        for i in range(0, 26, 2): # md5 hashes are 32 hex digits long, we only want part of it to create the filepath
-            cae_filepath += hash_val[i] + hash_val[i + 1] + "/"
-        cae_filename = hash_val[26:] + image_extension
+    def insert_rows_with_images(self, table_name, rows, image_id_col="image_id", batch_size=10000, use_copy=True):
+        """
+        Insert many rows with images into the database. Ids for all rows are reserved with one query and the
+        rows are streamed with bulk_load. If the table has checksum/file_size columns, the images are hashed in
+        parallel and their hashes and sizes recorded. Does not commit the insertion into the database or send
+        the images until commit is called
+        Note: like insert_rows, values are plain python values (strings should NOT be wrapped in '')
+
+        @param table_name : str             - table to insert into
+        @param rows : List[Dict[str, any]]  - dictionaries of column name, value pairs to insert, each with a filepath
+        @param image_id_col: str            - name of the id (primary key) column in the table, must have a sequence (default: image_id)
+        @param batch_size : int             - number of rows sent to the database at once (default: 10000)
+        @param use_copy : bool              - use COPY FROM STDIN, otherwise batched INSERTs (default: True)
+        @return List[int]                   - image ids of the inserted rows
+        """
+        ids = self._reserve_ids(table_name, image_id_col, len(rows))
+        assert ids is not None, f"Column {image_id_col} of {table_name} must be serial/identity to insert rows in bulk"
 
-        # update row with correct filepath
-        self.sql(f"UPDATE {table_name} SET filepath = '{cae_filepath}{cae_filename}' WHERE image_id = {image_id}")
+        for value_dict in rows:
+            assert "filepath" in value_dict, "The values you insert must contain a filepath attribute with the local filepath of the image"
+            assert os.path.isfile(value_dict["filepath"]), f"The path {value_dict['filepath']} to the image is invalid"
+        checksums = self._checksums(table_name, [value_dict["filepath"] for value_dict in rows])
 
-        # prepare to upload image later
-        self.uncomitted_image_paths.append((local_filepath, cae_filepath, cae_filename))
+        value_dicts = []
+        uploads = []
+        for value_dict, image_id, checksum in zip(rows, ids, checksums):
+            local_filepath = value_dict["filepath"]
+            cae_filepath, cae_filename = self._cae_path(table_name, image_id, local_filepath)
+            value_dicts.append(dict(value_dict, **checksum, **{image_id_col: image_id, "filepath": cae_filepath + cae_filename}))
+            uploads.append((local_filepath, cae_filepath, cae_filename, table_name, checksum.get(CHECKSUM_COLUMN)))
 
-        return image_id 
+        self.bulk_load(table_name, value_dicts, batch_size, use_copy)
+        for upload in uploads:
+            self._queue_upload(*upload)
+        return ids
+
+    def add_checksum_columns(self, table_name):
+        """
+        Adds the checksum and file_size columns to an image table. Images inserted from then on have their
+        sha256 hash and size recorded, and downloads of them are verified against it
+
+        @param table_name : str - table that contains the images
+        """
+        self.sql(
+            f"""
+            ALTER TABLE {table_name}
+                ADD COLUMN IF NOT EXISTS {CHECKSUM_COLUMN} varchar(64),
+                ADD COLUMN IF NOT EXISTS {FILE_SIZE_COLUMN} bigint
+            """)
 
-    def download_data(self, table_name, label_column_names, output_path, format_type, image_id="image_id", filter_sql=[]):
+    def download_data(self, table_name, label_column_names, output_path, format_type, image_id="image_id", filter_sql=None, batch_size=1000, sync=False, export_options=None):
         """
         Downloads data from existing table on the database. Executes and commits any filters from filter_sql 
         before downloading. Download format can be specified by format_type. Images and labels will be downloaded 
-        to output_path/images and output_path/labels respectively.
+        to output_path/images and output_path/labels respectively. Rows are streamed from the database, so
+        downloading starts as soon as the first batch arrives. With sync, only images that are new or changed
+        since the last download into output_path are transferred and images that no longer match are deleted
 
         @param table_name : str                 - table name
         @param label_column_names : List[str]   - list containing the columns to be in the label file in order
         @param output_path : str                - path to save images/labels in
-        @param format_type : str                - download format
+        @param format_type : str                - download format (yolo, coco or tar)
         @param image_id : str                   - column that the two tables will be joined on
         @param filter_sql : List[str]           - list of sql queries to execute before joining the tables
+        @param batch_size : int                 - number of rows fetched from the database at once (default: 1000)
+        @param sync : bool                      - update an earlier download in output_path instead of replacing it (default: False)
+        @param export_options : Dict[str, any]  - extra arguments for the exporter of format_type, e.g. {"shard_size": 1000} for tar (default: None)
         """
-        for sql_op in filter_sql:
+        for sql_op in filter_sql or []:
             self.sql(sql_op)
         self.commit()
 
-        records = self.sql(f"SELECT * FROM {table_name}")
+        # rows are ordered by image so that all labels of an image arrive together
+        self._download_query(f"SELECT * FROM {table_name} ORDER BY {image_id}", None, label_column_names, output_path, format_type, image_id, batch_size, sync, export_options)
 
-        column_names = {self.cursor.description[i][0] : i for i in range(len(self.cursor.description))}
-        assert all([name in column_names for name in label_column_names]), "Invalid column name in label column names"
-
-        if format_type == "yolo":
-            self._download_data_yolo(records, label_column_names, column_names, output_path, image_id)
-
-    def join_and_download_data(self, images_table_name, labels_table_name, label_column_names, output_path, format_type, image_id="image_id", filter_sql=[]):
+    def join_and_download_data(self, images_table_name, labels_table_name, label_column_names, output_path, format_type, image_id="image_id", filter_sql=None, batch_size=1000, sync=False, export_options=None):
         """
         Downloads data from the join of two tables (image table and labels table). Executes and commits
         any filters from filter_sql onto the table before the join. Download format can be specified
         by format_type. Images and labels will be downloaded to output_path/images and output_path/labels
-        respectively.
+        respectively. With sync, only images that are new or changed since the last download into
+        output_path are transferred and images that no longer match are deleted
 
         @param images_table_name : str          - table that contains the images
         @param labels_table_name : str          - table that contains the labels
         @param label_column_names : List[str]   - list containing the columns to be in the label file in order
         @param output_path : str                - path to save images/labels in
-        @param format_type : str                - download format
+        @param format_type : str                - download format (yolo, coco or tar)
         @param image_id : str                   - column that the two tables will be joined on
         @param filter_sql : List[str]           - list of sql queries to execute before joining the tables
+        @param batch_size : int                 - number of rows fetched from the database at once (default: 1000)
+        @param sync : bool                      - update an earlier download in output_path instead of replacing it (default: False)
+        @param export_options : Dict[str, any]  - extra arguments for the exporter of format_type, e.g. {"shard_size": 1000} for tar (default: None)
         """
-        temp_table_name = images_table_name + "_" + labels_table_name + "_tmp"
-        filter_sql.append(
-            f"""
-            DROP TABLE IF EXISTS {temp_table_name};
-            SELECT *
-                INTO {temp_table_name}
-                FROM {images_table_name}
-                JOIN {labels_table_name}
-                USING ({image_id})
-            """
-        )
-        self.download_data(temp_table_name, label_column_names, output_path, format_type, image_id, filter_sql)
-        self.sql(f"DROP TABLE {temp_table_name}")
+        for sql_op in filter_sql or []:
+            self.sql(sql_op)
         self.commit()
 
-    def _download_data_yolo(self, records, label_column_names, column_names, output_path, image_id):
+        self.download_dataset(images_table_name, labels_table_name, label_column_names, output_path, format_type, image_id=image_id, batch_size=batch_size, sync=sync, export_options=export_options)
+
+    def download_dataset(self, images_table_name, labels_table_name, label_column_names, output_path, format_type, filters=None, classes=None, class_column="class_id", sample_percent=None, per_class=None, seed=None, image_id="image_id", batch_size=1000, sync=False, export_options=None):
         """
-        Data download specifically for yolo format
+        Downloads a filtered and/or sampled subset of the join of two tables (image table and labels table).
+        Filters, class selection and sampling are all done by the database in a single streamed query, so
+        nothing is copied into a temporary table. Images and labels will be downloaded to output_path/images
+        and output_path/labels respectively.
 
-        @param records : List[Tuple[any...]]    - contents of a sql table containing a filepath column and all the label_column_names
+        @param images_table_name : str          - table that contains the images (aliased as i in filters)
+        @param labels_table_name : str          - table that contains the labels (aliased as l in filters)
         @param label_column_names : List[str]   - list containing the columns to be in the label file in order
-        @param column_names: Dict[str, int]     - maps column names to their index in a row of the table
         @param output_path : str                - path to save images/labels in
+        @param format_type : str                - download format (yolo, coco or tar)
+        @param filters : List[str]              - sql conditions that every row must satisfy, e.g. "i.x_res >= 1280" (default: None)
+        @param classes : List[any]              - only download labels of these classes (default: None, all classes)
+        @param class_column : str               - column of the labels table containing the class (default: class_id)
+        @param sample_percent : float           - percent of images to randomly sample (default: None, all images)
+        @param per_class : int                  - download at most this many images per class for a balanced sample, each image counts
+                                                  for the rarest of its classes and keeps all of its labels (default: None)
+        @param seed : int                       - seed for sampling, the same seed gives the same sample (default: None, random)
         @param image_id : str                   - column that the two tables will be joined on
+        @param batch_size : int                 - number of rows fetched from the database at once (default: 1000)
+        @param sync : bool                      - update an earlier download in output_path instead of replacing it (default: False)
+        @param export_options : Dict[str, any]  - extra arguments for the exporter of format_type, e.g. {"shard_size": 1000} for tar (default: None)
+        """
+        sql_string, params = dataset_query(
+            images_table_name,
+            labels_table_name,
+            image_id=image_id,
+            filters=filters,
+            classes=classes,
+            class_column=class_column,
+            sample_percent=sample_percent,
+            per_class=per_class,
+            seed=seed
+        )
+        self._download_query(sql_string, params, label_column_names, output_path, format_type, image_id, batch_size, sync, export_options)
+
+    def _download_query(self, sql_string, params, label_column_names, output_path, format_type, image_id, batch_size, sync, export_options=None):
+        """
+        Streams the result of a query ordered by image id and downloads it in the given format. Images are
+        verified against the checksum/file_size columns if the query returns them
+
+        @param sql_string : str                 - query returning a filepath column and all the label_column_names
+        @param params : List[any]               - values substituted for %s placeholders in sql_string
+        @param label_column_names : List[str]   - list containing the columns to be in the label file in order
+        @param output_path : str                - path to save images/labels in
+        @param format_type : str                - download format (a name registered in exporters.EXPORTERS)
+        @param image_id : str                   - image id column
+        @param batch_size : int                 - number of rows fetched from the database at once
+        @param sync : bool                      - update an earlier download in output_path instead of replacing it
+        @param export_options : Dict[str, any]  - extra arguments for the exporter of format_type (default: None)
         """
-        image_remote_filepaths = {}
-        label_dict = defaultdict(str)
-        for row in records:
-            image_id_val = row[column_names[image_id]]
-            if image_id_val not in image_remote_filepaths:
-                image_remote_filepaths[image_id_val] = row[column_names["filepath"]]
+        assert format_type in EXPORTERS, f"Invalid format type {format_type}, expected one of {list(EXPORTERS)}"
+        assert not sync or EXPORTERS[format_type].supports_sync, f"Format type {format_type} does not support sync"
+
+        column_names, batches = self._iter_batches(sql_string, batch_size, params)
+        try:
+            assert all([name in column_names for name in label_column_names]), "Invalid column name in label column names"
+            exporter = EXPORTERS[format_type](output_path, label_column_names, column_names, **(export_options or {}))
+        except Exception:
+            batches.close()
+            raise
 
-            label = " ".join([str(row[column_names[name]]) for name in label_column_names])
-            label_dict[image_id_val] += label + "\n"
+        # images are verified against the checksum columns when the query returns them
+        checksum_index = column_names.get(CHECKSUM_COLUMN)
+        size_index = column_names.get(FILE_SIZE_COLUMN)
 
-        if output_path[-1] != "/":
-            output_path += "/"
-        if not os.path.exists(output_path + "images"):
-            os.mkdir(output_path + "images")
-        if not os.path.exists(output_path + "labels"):
-            os.mkdir(output_path + "labels")
+        def images():
+            for image_id_val, path, rows, label in self._iter_images(batches, column_names, image_id, label_column_names, exporter.label_precision):
+                checksum = (
+                    rows[0][size_index] if size_index is not None else None,
+                    rows[0][checksum_index] if checksum_index is not None else None
+                )
+                yield path, exporter.add(image_id_val, path, rows, label), checksum
 
+        manifest = SyncManifest(exporter.output_path) if sync else None
         print("Downloading images")
-        image_remote_filepaths = list(image_remote_filepaths.items())
-        for i in tqdm(range(len(image_remote_filepaths))):
-            image_id_val, path = image_remote_filepaths[i]
-            image_extension = "." + path.split(".")[-1]
-            self._download_image(output_path + "images/" + str(image_id_val) + image_extension, path)
-
-        print("Writing labels")
-        labels = list(label_dict.items())
-        for i in tqdm(range(len(labels))):
-            image_id_val, label_str = labels[i]
-            with open(output_path + "labels/" + str(image_id_val) + ".txt", "w") as f:
-                f.write(label_str)
+        self.transfer.download(images(), cache=self.image_cache, manifest=manifest, on_done=exporter.image_done)
+        exporter.finish()
+
+        if manifest is not None:
+            stale = manifest.stale()
+            print(f"Deleting {len(stale)} images that no longer match")
+            for key in stale:
+                exporter.remove(key)
+                manifest.remove(key)
+            manifest.save()
+
+    @staticmethod
+    def _iter_images(batches, column_names, image_id, label_column_names, label_precision):
+        """
+        Groups the rows of each image and formats their labels. Labels are formatted a batch at a time
+        on columnar numpy arrays; rows of the last image of a batch are held back until the next batch
+        in case that image continues there
+
+        @param batches : Iterable[List[Tuple[any...]]]  - batches of rows ordered by image id
+        @param column_names: Dict[str, int]             - maps column names to their index in a row of the table
+        @param image_id : str                           - image id column
+        @param label_column_names : List[str]           - list containing the columns to be in the label in order
+        @param label_precision : int                    - number of decimals written for float label columns
+        @return Iterator[Tuple[any, str, List[Tuple[any...]], str]] - image id, remote filepath, rows and label text of each image
+        """
+        id_index = column_names[image_id]
+        path_index = column_names["filepath"]
+        label_indices = [column_names[name] for name in label_column_names]
+
+        def complete_images(rows):
+            image_ids, columns = label_columns(rows, id_index, label_indices)
+            order, groups = format_labels(image_ids, columns, label_precision)
+            rows = [rows[i] for i in order.tolist()]
+            for image_id_val, start, end, label in groups:
+                yield image_id_val, rows[start][path_index], rows[start:end], label
+
+        held_back = []
+        for batch in batches:
+            if not batch:
+                continue
+            last_id = batch[-1][id_index]
+            split = len(batch)
+            while split > 0 and batch[split - 1][id_index] == last_id:
+                split -= 1
+            if split == 0: # the whole batch belongs to the held back image
+                held_back += batch
+                continue
+            yield from complete_images(held_back + batch[:split])
+            held_back = batch[split:]
+        if held_back:
+            yield from complete_images(held_back)
+
+    def _iter_batches(self, sql_string, batch_size, params=None):
+        """
+        Executes a query with a named (server-side) cursor. The first batch is fetched right
+        away so that the column names are known
+
+        @param sql_string : str     - string containing sql query
+        @param batch_size : int     - number of rows fetched from the database at once
+        @param params : List[any]   - values substituted for %s placeholders in sql_string (default: None)
+        @return Tuple[Dict[str, int], Iterator[List[Tuple[any...]]]] - maps column names to their index in a row,
+                                      and the batches of rows (the cursor is closed once they are exhausted)
+        """
+        cursor = self.connection.cursor(name=f"wa_cursor_{next(self._cursor_ids)}")
+        try:
+            cursor.execute(sql_string, params)
+            first_batch = cursor.fetchmany(batch_size)
+        except Exception:
+            cursor.close()
+            raise
+        column_names = {cursor.description[i][0] : i for i in range(len(cursor.description))}
+
+        def batches():
+            try:
+                batch = first_batch
+                while batch:
+                    yield batch
+                    batch = cursor.fetchmany(batch_size)
+            finally:
+                cursor.close()
+
+        return column_names, batches()
+
+    def _load_batch(self, table_name, batch, use_copy):
+        """
+        Sends one batch of rows to the database
+
+        @param table_name : str                 - table to insert into
+        @param batch : List[Dict[str, any]]     - rows to insert, all with the same columns
+        @param use_copy : bool                  - use COPY FROM STDIN, otherwise batched INSERTs
+        @return int                             - number of rows inserted
+        """
+        col_names = list(batch[0].keys())
+        self._check_columns(table_name, col_names)
+        rows = []
+        for value_dict in batch:
+            assert len(value_dict) == len(col_names) and all(name in value_dict for name in col_names), "All rows in a batch must have the same columns"
+            rows.append([value_dict[name] for name in col_names])
+
+        if use_copy:
+            # COPY always writes the given values, even to GENERATED ALWAYS identity columns
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write("\t".join(self._copy_value(val) for val in row) + "\n")
+            buffer.seek(0)
+            self.cursor.copy_expert(f"COPY {table_name} ({', '.join(col_names)}) FROM STDIN", buffer)
+        else:
+            psycopg2.extras.execute_values(
+                self.cursor,
+                f"INSERT INTO {table_name} ({', '.join(col_names)}) {self._overriding(table_name, col_names)} VALUES %s",
+                rows,
+                page_size=len(rows)
+            )
+        return len(rows)
+
+    def _check_columns(self, table_name, col_names):
+        """
+        Checks that the column names are in the table schema
+
+        @table_name : str       - table name
+        @col_names : List[str]  - column names to check
+        @return Dict[str, str]  - maps column names of the table to their data type
+        """
+        catalog = self._get_catalog()
+        assert table_name in catalog, "Table name is not in the database"
+        schema_dict = {col[0]: col[1] for col in catalog[table_name]}
+        for col_name in col_names:
+            assert col_name in schema_dict, "Invalid column name in the value dictionary"
+        return schema_dict
+
+    def _overriding(self, table_name, col_names):
+        """
+        Gets the clause an INSERT needs to write the given columns: explicit values for a GENERATED ALWAYS
+        identity column (such as ids reserved by _reserve_ids) are only accepted with OVERRIDING SYSTEM VALUE
+
+        @table_name : str       - table name
+        @col_names : List[str]  - columns that are inserted
+        @return str             - "OVERRIDING SYSTEM VALUE" or an empty string
+        """
+        self._get_catalog()
+        if any((table_name, col_name) in self._always_identity for col_name in col_names):
+            return "OVERRIDING SYSTEM VALUE"
+        return ""
 
     def _check_schema(self, table_name, value_dict):
         """
@@ -257,11 +829,8 @@ class PostgresDatabase:
 
         @table_name : str - table name
         """
-        assert table_name in self.tables, "Table name is not in the database"
-        schema = self.get_schema(table_name)
-        schema_dict = {col[0]: col[1] for col in schema}
+        schema_dict = self._check_columns(table_name, value_dict.keys())
         for col_name in value_dict.keys(): # iterate through columns in the val dict
-            assert col_name in schema_dict, "Invalid column name in the value dictionary"
             if schema_dict[col_name] == "character varying": # if column is string type
                 # make sure that the value is contained in ''
                 new_val = value_dict[col_name]
@@ -271,44 +840,228 @@ class PostgresDatabase:
                     new_val += "'"
                 value_dict[col_name] = new_val
 
-    def _upload_image(self, local_filepath, remote_filepath, remote_filename):
-        """ 
-        Uploads image to the remote machine using SFTP
+    def _reserve_ids(self, table_name, image_id_col, count):
+        """
+        Takes ids from the block reserved from the sequence of a table's id column, reserving
+        another block with a single query when it runs out
+
+        @param table_name : str     - table name
+        @param image_id_col : str   - id column of the table
+        @param count : int          - number of ids needed
+        @return List[int]           - ids (None if the column has no sequence)
+        """
+        # the connection is leased before taking the lock: a thread waiting for a pool slot while holding the lock
+        # would deadlock with the threads that hold the slots and wait for the lock
+        self.connection
+        with self._lock:
+            return self._take_ids(table_name, image_id_col, count)
+
+    def _take_ids(self, table_name, image_id_col, count):
+        """
+        Takes ids for _reserve_ids (the lock must be held)
+        """
+        key = (table_name, image_id_col)
+        if key not in self._id_blocks:
+            self._id_blocks[key] = deque()
+        ids = self._id_blocks[key]
+        if ids is None: # already known to have no sequence
+            return None
+        if len(ids) < count:
+            records = self.sql(
+                f"""
+                SELECT nextval(pg_get_serial_sequence('{table_name}', '{image_id_col}'))
+                    FROM generate_series(1, {max(count - len(ids), ID_BLOCK_SIZE)})
+                """)
+            if records[0][0] is None:
+                self._id_blocks[key] = None
+                return None
+            ids.extend(record[0] for record in records)
+        return [ids.popleft() for _ in range(count)]
+
+    def _cae_path(self, table_name, image_id, local_filepath):
+        """
+        Generates where an image is stored on CAE storage from the md5 hash of its id
+
+        @param table_name : str     - table the image is inserted into
+        @param image_id : int       - id of the image
+        @param local_filepath : str - path to image on local machine (used for the extension)
+        @return Tuple[str, str]     - remote filepath (directory) and remote filename
+        """
+        hash_val = str(hashlib.md5(repr(image_id).encode()).hexdigest())
+        image_extension = "." + local_filepath.split(".")[-1]
+        cae_filepath = f"{CAE_ROOT}{table_name}/"
+        for i in range(0, 26, 2): # md5 hashes are 32 hex digits long, we only want part of it to create the filepath
+            cae_filepath += hash_val[i] + hash_val[i + 1] + "/"
+        cae_filename = hash_val[26:] + image_extension
+        return cae_filepath, cae_filename
+
+    def _checksums(self, table_name, local_filepaths):
+        """
+        Gets the values of the checksum/file_size columns of a table for images, hashing them in parallel
+        (only the columns that exist in the table are returned)
+
+        @param table_name : str             - table the images are inserted into
+        @param local_filepaths : List[str]  - paths to images on local machine
+        @return List[Dict[str, any]]        - column name, value pairs of each image
+        """
+        schema = {col[0] for col in self._get_catalog().get(table_name, [])}
+        assert not self.dedup or CHECKSUM_COLUMN in schema, f"Table {table_name} needs a {CHECKSUM_COLUMN} column to deduplicate images (see add_checksum_columns)"
+        checksums = [{} for _ in local_filepaths]
+        if FILE_SIZE_COLUMN in schema:
+            for checksum, local_filepath in zip(checksums, local_filepaths):
+                checksum[FILE_SIZE_COLUMN] = os.path.getsize(local_filepath)
+        if CHECKSUM_COLUMN in schema:
+            # hashlib releases the GIL while hashing, so reading and hashing of different images overlap. A single
+            # image (insert_row_with_image) is hashed on the calling thread
+            if len(local_filepaths) == 1:
+                sha256s = [file_sha256(local_filepaths[0])]
+            else:
+                sha256s = self._hash_executor.map(file_sha256, local_filepaths)
+            for checksum, sha256 in zip(checksums, sha256s):
+                checksum[CHECKSUM_COLUMN] = sha256
+        return checksums
+
+    def _queue_upload(self, local_filepath, remote_filepath, remote_filename, table_name=None, checksum=None):
+        """
+        Starts uploading an image in the background or prepares to upload it on commit
 
         @local_filepath : str   - path to image on local machine
         @remote_filepath : str  - where to store image on remote machine
         @remote_filename : str  - what to call file on remote machine
+        @table_name : str       - table the image was inserted into (needed with dedup)
+        @checksum : str         - sha256 hash of the image (needed with dedup)
         """
-        sftp = self.client.get_sftp_client()
-        self.client.exec_command(f"mkdir -p '{remote_filepath}'")
-        while True:
-            try:
-                sftp.put(local_filepath, remote_filepath + remote_filename)
-                break
-            except:
-                time.sleep(0.1)
+        if self.dedup:
+            self._dedup_images.append((table_name, checksum, local_filepath, remote_filepath, remote_filename))
+        elif self.uploader is not None:
+            self.uploader.put(local_filepath, remote_filepath, remote_filename, self._owner())
+        else:
+            self.uncomitted_image_paths.append((local_filepath, remote_filepath, remote_filename))
 
-    def _download_image(self, local_filepath, remote_filepath):
-        """ 
-        Downloads image to the remote machine using SFTP
+    def _deduplicate(self):
+        """
+        Finds the images inserted since the last commit whose content is already stored (by an earlier
+        commit or an earlier image of this one) with one query per table, and points their rows to the
+        stored image with one update per table
 
-        @local_filepath : str   - where to store image on local machine
-        @remote_filepath : str  - path to image on remote machine
+        @return List[Tuple[str, str, str]] - (local filepath, remote filepath, remote filename) of the images that still need to be uploaded
         """
-        sftp = self.client.get_sftp_client()
-        sftp.stat(remote_filepath)
-        while True:
-            try:
-                sftp.get(remote_filepath, local_filepath)
-                break
-            except:
-                time.sleep(0.1)
+        tables = {}
+        for image in self._dedup_images:
+            tables.setdefault(image[0], []).append(image)
+
+        uploads = []
+        num_duplicates = 0
+        for table_name, images in tables.items():
+            self.cursor.execute(
+                f"""
+                SELECT DISTINCT ON ({CHECKSUM_COLUMN}) {CHECKSUM_COLUMN}, filepath
+                    FROM {table_name}
+                    WHERE {CHECKSUM_COLUMN} = ANY(%s) AND NOT filepath = ANY(%s)
+                """,
+                ([checksum for _, checksum, _, _, _ in images], [remote_filepath + remote_filename for _, _, _, remote_filepath, remote_filename in images])
+            )
+            stored = dict(self.cursor.fetchall())
+
+            redirects = [] # (filepath of the new row, filepath of the stored image)
+            for _, checksum, local_filepath, remote_filepath, remote_filename in images:
+                if checksum in stored:
+                    redirects.append((remote_filepath + remote_filename, stored[checksum]))
+                else:
+                    stored[checksum] = remote_filepath + remote_filename
+                    uploads.append((local_filepath, remote_filepath, remote_filename))
+            if redirects:
+                psycopg2.extras.execute_values(
+                    self.cursor,
+                    f"UPDATE {table_name} SET filepath = v.stored FROM (VALUES %s) AS v(new, stored) WHERE {table_name}.filepath = v.new",
+                    redirects,
+                    page_size=len(redirects)
+                )
+            num_duplicates += len(redirects)
 
+        print(f"Skipping {num_duplicates} images that are already stored")
+        return uploads
+
+    def _remove_remote_images(self, image_paths):
+        """
+        Deletes images that were put in place for a transaction that failed to commit, so that no image
+        without a row is left on CAE storage. Failures are only reported, the original error matters more
+
+        @param image_paths : List[Tuple[str, str]] - (remote filepath, remote filename) of each image
+        """
+        if not image_paths:
+            return
+        try:
+            self.transfer.run_batched(f"rm -f {shlex.quote(remote_filepath + remote_filename)}" for remote_filepath, remote_filename in image_paths)
+        except Exception as e:
+            print(f"Failed to delete {len(image_paths)} images of the failed commit: {e}")
+
+    def _owner(self):
+        """
+        Identifies the transaction of the calling thread for the background uploader
+        """
+        return threading.get_ident() if self.pool is not None else None
+
+    def _release(self, close=False):
+        """
+        Returns the connection of the calling thread to the pool (in pooled mode)
+
+        @param close : bool - close the connection instead of reusing it (default: False)
+        """
+        connection = getattr(self._local, "connection", None)
+        if self.pool is None or connection is None:
+            return
+        cursor, pool = self._local.cursor, self._local.pool
+        self._local.connection = None
+        self._local.cursor = None
+        self._local.pool = None
+        try:
+            cursor.close()
+        finally:
+            if pool is self.pool:
+                pool.putconn(connection, close=close)
+            else:
+                # leased from a pool that was replaced (and closed) by _replace_pool
+                connection.close()
+            self._pool_slots.release()
+
+    def _replace_pool(self):
+        """
+        Replaces the pool if the SSH connection was re-established since it was opened (by any thread,
+        or the keepalive monitor). Its connections, also those leased by other threads, are closed: those
+        threads get a connection from the new pool once they reconnect. The pool slots are kept, so the
+        leases still held on the old pool count until they are released
+        """
+        with self._pool_lock:
+            if self.client.reconnects == self._pool_reconnects:
+                return
+            old_pool = self.pool
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, old_pool.maxconn, self.conn_string)
+            self._pool_reconnects = self.client.reconnects
+        old_pool.closeall()
+
+    @staticmethod
+    def _copy_value(val):
+        """
+        Formats a value for the text format of COPY FROM STDIN
+
+        @val : any  - value to format (None is inserted as NULL)
+        @return str - escaped value
+        """
+        if val is None:
+            return "\\N"
+        return str(val).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
 
     @property
     def tables(self):
         """
         Lists all the tables in the database
         """
-        records = self.sql("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
-        return [record[0] for record in records]
+        return list(self._get_catalog().keys())
+
+    @property
+    def catalog_stats(self):
+        """
+        Hit/miss counters of the catalog cache (a miss costs one metadata query)
+        """
+        return {"hits": self.catalog_hits, "misses": self.catalog_misses}
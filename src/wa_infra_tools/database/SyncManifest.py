@@ -0,0 +1,104 @@
+"""
+This file contains the SyncManifest class which records what has been downloaded
+into a dataset directory so that later downloads only transfer what changed
+"""
+import json
+import os
+import threading
+
+class SyncManifest:
+    FILENAME = "manifest.json"
+
+    def __init__(self, output_path):
+        """
+        Constructs a SyncManifest object, loading output_path/manifest.json if it exists
+
+        @param output_path : str - dataset directory the manifest describes
+        """
+        self.output_path = output_path
+        self.filepath = os.path.join(output_path, self.FILENAME)
+        self.entries = {}
+        if os.path.isfile(self.filepath):
+            with open(self.filepath) as f:
+                self.entries = json.load(f)
+
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def is_current(self, local_filepath, remote_path, attrs):
+        """
+        Checks whether a local file is an up to date copy of a remote file, and marks it as part of the dataset
+
+        @param local_filepath : str         - path to the file on the local machine
+        @param remote_path : str            - path to the file on the remote machine
+        @param attrs : SFTPAttributes       - current attributes of the remote file
+        @return bool                        - True if the file does not need to be downloaded
+        """
+        key = self._key(local_filepath)
+        with self._lock:
+            self._seen.add(key)
+            entry = self.entries.get(key)
+        return (
+            entry is not None
+            and entry["remote_path"] == remote_path
+            and entry["size"] == attrs.st_size
+            and entry["mtime"] == attrs.st_mtime
+            and os.path.isfile(local_filepath)
+            and os.path.getsize(local_filepath) == attrs.st_size
+        )
+
+    def update(self, local_filepath, remote_path, attrs=None, sha256=None):
+        """
+        Records that a remote file was downloaded to local_filepath
+
+        @param local_filepath : str         - path to the file on the local machine
+        @param remote_path : str            - path to the file on the remote machine
+        @param attrs : SFTPAttributes       - attributes of the remote file when it was downloaded (default: None, only the
+                                              local size is recorded and is_current will not match the file)
+        @param sha256 : str                 - hash of the file (default: None)
+        """
+        key = self._key(local_filepath)
+        entry = {
+            "remote_path": remote_path,
+            "size": attrs.st_size if attrs is not None else os.path.getsize(local_filepath),
+            "mtime": attrs.st_mtime if attrs is not None else None
+        }
+        if sha256 is not None:
+            entry["sha256"] = sha256
+        with self._lock:
+            self._seen.add(key)
+            self.entries[key] = entry
+
+    def stale(self):
+        """
+        Lists the files in the manifest that were not part of the latest download
+
+        @return List[str] - paths of the files relative to output_path
+        """
+        with self._lock:
+            return [key for key in self.entries if key not in self._seen]
+
+    def remove(self, key):
+        """
+        Drops a file from the manifest
+
+        @param key : str - path of the file relative to output_path
+        """
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        """
+        Writes the manifest to output_path/manifest.json (atomically, so an interrupted save leaves the old one)
+        """
+        with self._lock:
+            contents = json.dumps(self.entries)
+        with open(self.filepath + ".tmp", "w") as f:
+            f.write(contents)
+        os.replace(self.filepath + ".tmp", self.filepath)
+
+    def _key(self, local_filepath):
+        """
+        Gets the path of a file relative to output_path, which is what the manifest is keyed by
+        """
+        return os.path.relpath(local_filepath, self.output_path)
@@ -1 +1,3 @@
 from wa_infra_tools.database.PostgresDatabase import PostgresDatabase
+from wa_infra_tools.database.ImageCache import ImageCache
+from wa_infra_tools.database.AsyncPostgresDatabase import AsyncPostgresDatabase
@@ -0,0 +1,240 @@
+"""
+This file contains the exporters that write downloaded datasets in each format.
+Exporters are registered by format name with register_exporter and selected by
+the format_type argument of the PostgresDatabase download functions
+"""
+import io
+import json
+import os
+import shutil
+import tarfile
+
+EXPORTERS = {}
+
+def register_exporter(format_type):
+    """
+    Class decorator that makes an exporter available as format_type
+
+    @param format_type : str - name of the format
+    """
+    def register(cls):
+        EXPORTERS[format_type] = cls
+        return cls
+    return register
+
+class Exporter:
+    """
+    Base class of the exporters. For every image of the dataset (in image id order), add is called
+    with its rows before the image is downloaded and image_done is called once it has been downloaded
+    """
+    # whether the exporter writes images to fixed paths that a SyncManifest can track
+    supports_sync = True
+
+    def __init__(self, output_path, label_column_names, column_names, label_precision=6):
+        """
+        @param output_path : str                - path to save the dataset in
+        @param label_column_names : List[str]   - list containing the columns to be in the label of each image in order
+        @param column_names : Dict[str, int]    - maps column names to their index in a row
+        @param label_precision : int            - number of decimals written for float label columns (default: 6)
+        """
+        self.output_path = output_path if output_path.endswith("/") else output_path + "/"
+        self.label_column_names = label_column_names
+        self.column_names = column_names
+        self.label_precision = label_precision
+        os.makedirs(self.output_path, exist_ok=True)
+
+    def add(self, image_id_val, remote_path, rows, label):
+        """
+        Adds an image to the dataset
+
+        @param image_id_val : any               - id of the image
+        @param remote_path : str                - path to the image on the remote machine
+        @param rows : List[Tuple[any...]]       - rows of the image
+        @param label : str                      - label columns of the rows, one line of space separated values per row
+        @return str                             - where the image should be downloaded to
+        """
+        raise NotImplementedError
+
+    def image_done(self, remote_path, local_filepath):
+        """
+        Called in dataset order once an image has been downloaded
+
+        @param remote_path : str    - path to the image on the remote machine
+        @param local_filepath : str - where the image was downloaded to
+        """
+        pass
+
+    def finish(self):
+        """
+        Called once every image has been downloaded
+        """
+        pass
+
+    def remove(self, key):
+        """
+        Deletes an image that is no longer part of the dataset (used with sync)
+
+        @param key : str - path of the image relative to output_path
+        """
+        for path in (self.output_path + key, self.output_path + key + ".part", self.output_path + key + ".part.source"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def image_filename(image_id_val, remote_path):
+        """
+        Gets the name an image is saved under (its id with the extension of the remote file)
+        """
+        return str(image_id_val) + "." + remote_path.split(".")[-1]
+
+@register_exporter("yolo")
+class YoloExporter(Exporter):
+    """
+    Writes images to output_path/images and one label file per image to output_path/labels
+    """
+    def __init__(self, output_path, label_column_names, column_names, label_precision=6):
+        super().__init__(output_path, label_column_names, column_names, label_precision)
+        os.makedirs(self.output_path + "images", exist_ok=True)
+        os.makedirs(self.output_path + "labels", exist_ok=True)
+
+    def add(self, image_id_val, remote_path, rows, label):
+        # label files are written on the main thread while the worker threads download images
+        with open(self.output_path + "labels/" + str(image_id_val) + ".txt", "w") as f:
+            f.write(label)
+        return self.output_path + "images/" + self.image_filename(image_id_val, remote_path)
+
+    def remove(self, key):
+        super().remove(key)
+        label_path = self.output_path + "labels/" + os.path.splitext(os.path.basename(key))[0] + ".txt"
+        if os.path.exists(label_path):
+            os.remove(label_path)
+
+@register_exporter("coco")
+class CocoExporter(Exporter):
+    """
+    Writes images to output_path/images and a single COCO annotations file. Boxes are read from normalized
+    center/size columns and converted to pixels with the resolution columns of the image
+    """
+    def __init__(self, output_path, label_column_names, column_names, category_column="class_id", category_name_column=None,
+                 bbox_columns=("center_norm_x", "center_norm_y", "width_norm", "height_norm"), width_column="x_res", height_column="y_res",
+                 annotations_file="annotations.json", label_precision=6):
+        """
+        @param category_column : str        - column containing the category id (default: class_id)
+        @param category_name_column : str   - column containing the category name (default: None, use the id)
+        @param bbox_columns : Tuple[str]    - normalized center x, center y, width and height columns
+        @param width_column : str           - column containing the width of the image in pixels (default: x_res)
+        @param height_column : str          - column containing the height of the image in pixels (default: y_res)
+        @param annotations_file : str       - name of the annotations file in output_path (default: annotations.json)
+        """
+        super().__init__(output_path, label_column_names, column_names, label_precision)
+        for name in (category_column, width_column, height_column) + tuple(bbox_columns) + ((category_name_column,) if category_name_column else ()):
+            assert name in column_names, f"Column {name} needed for coco format is not in the query result"
+        self.category_index = column_names[category_column]
+        self.category_name_index = column_names[category_name_column] if category_name_column else None
+        self.bbox_indices = [column_names[name] for name in bbox_columns]
+        self.width_index = column_names[width_column]
+        self.height_index = column_names[height_column]
+        self.annotations_path = self.output_path + annotations_file
+        os.makedirs(self.output_path + "images", exist_ok=True)
+
+        # images and annotations are streamed to temporary files and joined into one json file at the end
+        self.images_file = open(self.annotations_path + ".images", "w")
+        self.annotations_file = open(self.annotations_path + ".annotations", "w")
+        self.categories = {}
+        self.num_images = 0
+        self.num_annotations = 0
+
+    def add(self, image_id_val, remote_path, rows, label):
+        filename = self.image_filename(image_id_val, remote_path)
+        width = int(rows[0][self.width_index])
+        height = int(rows[0][self.height_index])
+        self.images_file.write(("," if self.num_images else "") + json.dumps({"id": image_id_val, "file_name": filename, "width": width, "height": height}))
+        self.num_images += 1
+
+        for row in rows:
+            category_id = row[self.category_index]
+            if category_id not in self.categories:
+                name = row[self.category_name_index] if self.category_name_index is not None else category_id
+                self.categories[category_id] = str(name)
+            center_x, center_y, box_width, box_height = [float(row[i]) for i in self.bbox_indices]
+            box_width *= width
+            box_height *= height
+            self.num_annotations += 1
+            self.annotations_file.write(("," if self.num_annotations > 1 else "") + json.dumps({
+                "id": self.num_annotations,
+                "image_id": image_id_val,
+                "category_id": category_id,
+                "bbox": [center_x * width - box_width / 2, center_y * height - box_height / 2, box_width, box_height],
+                "area": box_width * box_height,
+                "iscrowd": 0
+            }))
+        return self.output_path + "images/" + filename
+
+    def finish(self):
+        self.images_file.close()
+        self.annotations_file.close()
+        categories = [{"id": category_id, "name": name} for category_id, name in sorted(self.categories.items())]
+        with open(self.annotations_path, "w") as f:
+            f.write('{"images": [')
+            with open(self.images_file.name) as images_file:
+                shutil.copyfileobj(images_file, f)
+            f.write('], "annotations": [')
+            with open(self.annotations_file.name) as annotations_file:
+                shutil.copyfileobj(annotations_file, f)
+            f.write('], "categories": ' + json.dumps(categories) + "}")
+        os.remove(self.images_file.name)
+        os.remove(self.annotations_file.name)
+
+@register_exporter("tar")
+class TarExporter(Exporter):
+    """
+    Writes the dataset as sharded tar archives (WebDataset layout): each sample is stored as <image id>.<ext>
+    next to its label <image id>.txt, and a new shard-XXXXXX.tar is started every shard_size samples
+    """
+    supports_sync = False
+
+    def __init__(self, output_path, label_column_names, column_names, shard_size=1000, label_precision=6):
+        """
+        @param shard_size : int - number of samples per shard (default: 1000)
+        """
+        super().__init__(output_path, label_column_names, column_names, label_precision)
+        self.shard_size = shard_size
+        self.download_dir = self.output_path + ".download/"
+        os.makedirs(self.download_dir, exist_ok=True)
+
+        self.pending = {} # local filepath -> (sample key, label) of images still downloading
+        self.shard = None
+        self.num_shards = 0
+        self.num_in_shard = 0
+
+    def add(self, image_id_val, remote_path, rows, label):
+        local_filepath = self.download_dir + self.image_filename(image_id_val, remote_path)
+        self.pending[local_filepath] = (str(image_id_val), label.encode())
+        return local_filepath
+
+    def image_done(self, remote_path, local_filepath):
+        key, label = self.pending.pop(local_filepath)
+        if self.shard is None or self.num_in_shard >= self.shard_size:
+            self._next_shard()
+
+        self.shard.add(local_filepath, arcname=os.path.basename(local_filepath))
+        label_info = tarfile.TarInfo(key + ".txt")
+        label_info.size = len(label)
+        self.shard.addfile(label_info, io.BytesIO(label))
+        self.num_in_shard += 1
+        os.remove(local_filepath)
+
+    def finish(self):
+        if self.shard is not None:
+            self.shard.close()
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def _next_shard(self):
+        """
+        Closes the current shard and starts the next one
+        """
+        if self.shard is not None:
+            self.shard.close()
+        self.shard = tarfile.open(self.output_path + f"shard-{self.num_shards:06d}.tar", "w")
+        self.num_shards += 1
+        self.num_in_shard = 0
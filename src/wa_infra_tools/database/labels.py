@@ -0,0 +1,186 @@
+"""
+This file contains the vectorized label formatting used when exporting datasets
+"""
+import math
+import numbers
+import numpy as np
+
+# byte used for the unused positions of fixed width fields, dropped before the text is returned
+PAD = 0
+
+def label_columns(rows, image_id_index, label_indices):
+    """
+    Converts rows into columnar numpy arrays
+
+    @param rows : List[Tuple[any...]]   - rows of a query result
+    @param image_id_index : int         - index of the image id in a row
+    @param label_indices : List[int]    - indices of the label columns in a row, in order
+    @return Tuple[np.ndarray, List[np.ndarray]] - image ids and label columns
+    """
+    columns = list(zip(*rows)) if rows else [()] * (max([image_id_index] + label_indices) + 1)
+    image_ids = np.asarray(columns[image_id_index])
+    labels = []
+    for index in label_indices:
+        column = np.asarray(columns[index])
+        # numeric sql types (e.g. decimal) come back as python objects
+        if column.dtype == object and all(isinstance(val, numbers.Number) for val in columns[index]):
+            column = column.astype(np.float64)
+        labels.append(column)
+    return image_ids, labels
+
+def format_labels(image_ids, columns, precision=6):
+    """
+    Formats label columns as one line of space separated values per row and groups the lines by image id.
+    Rows are grouped with a single (stable) sort. Integer columns are written as integers and float columns
+    with fixed precision; numeric batches are rendered to text with array operations over the whole batch
+
+    @param image_ids : np.ndarray       - image id of each row
+    @param columns : List[np.ndarray]   - label columns, in the order they appear on a line
+    @param precision : int              - number of decimals written for float columns (default: 6)
+    @return Tuple[np.ndarray, List[Tuple[any, int, int, str]]] - order that sorts the rows by image id, and the image id,
+                                              first and last (exclusive) index into the sorted rows and label text of each image
+    """
+    if len(image_ids) == 0:
+        return np.arange(0), []
+
+    order = np.argsort(image_ids, kind="stable")
+    image_ids = image_ids[order]
+    columns = [column[order] for column in columns]
+
+    starts = np.concatenate(([0], np.flatnonzero(image_ids[1:] != image_ids[:-1]) + 1)).tolist()
+    ends = starts[1:] + [len(image_ids)]
+    if columns and all(_is_numeric(column, precision) for column in columns):
+        texts = _format_numeric(columns, precision, starts, ends)
+    else:
+        texts = _format_strings(columns, precision, starts, ends)
+    return order, [(image_ids[start:start + 1].tolist()[0], start, end, text) for start, end, text in zip(starts, ends, texts)]
+
+def _is_numeric(column, precision):
+    """
+    Checks whether a column can be rendered with array operations (integers, or finite floats that fit in an int64 once scaled)
+    """
+    if np.issubdtype(column.dtype, np.integer) or np.issubdtype(column.dtype, np.bool_):
+        return True
+    if np.issubdtype(column.dtype, np.floating):
+        return bool(np.all(np.isfinite(column))) and float(np.abs(column).max()) * 10 ** precision < 2 ** 62
+    return False
+
+def _format_numeric(columns, precision, starts, ends):
+    """
+    Renders every row into a matrix of fixed width byte fields, drops the padding and splits the text by image
+
+    @return List[str] - label text of each image
+    """
+    num_rows = len(columns[0])
+    fields = []
+    for column in columns:
+        if fields:
+            fields.append(_constant(num_rows, " "))
+        if np.issubdtype(column.dtype, np.floating):
+            fields.append(_float_field(column, precision))
+        else:
+            fields.append(_int_field(column.astype(np.int64)))
+    fields.append(_constant(num_rows, "\n"))
+
+    matrix = np.hstack(fields)
+    keep = matrix != PAD
+    offsets = np.concatenate(([0], np.cumsum(keep.sum(axis=1)))).tolist()
+    text = matrix[keep].tobytes().decode("ascii")
+    return [text[offsets[start]:offsets[end]] for start, end in zip(starts, ends)]
+
+def _format_strings(columns, precision, starts, ends):
+    """
+    Fallback for batches with non numeric columns: formats each image's lines with one string operation.
+    Floats are rendered exactly like _format_numeric renders them, so the text of a value does not depend on
+    which path its batch took
+
+    @return List[str] - label text of each image
+    """
+    formats = []
+    for column in columns:
+        if np.issubdtype(column.dtype, np.integer) or np.issubdtype(column.dtype, np.bool_):
+            formats.append("%d")
+        else:
+            formats.append("%s")
+    line_format = " ".join(formats) + "\n"
+
+    # flatten the values row by row so each image is one contiguous slice
+    values = np.column_stack([_string_values(column, precision) for column in columns]).ravel().tolist() if columns else []
+    num_columns = len(columns)
+    return [(line_format * (end - start)) % tuple(values[start * num_columns:end * num_columns]) for start, end in zip(starts, ends)]
+
+def _string_values(column, precision):
+    """
+    Converts a column for _format_strings, rendering floats (also those in columns with NULLs) with _float_text
+    """
+    if np.issubdtype(column.dtype, np.floating):
+        return np.array([_float_text(value, precision) for value in column.tolist()], dtype=object)
+    if column.dtype == object:
+        return np.array([_float_text(value, precision) if isinstance(value, float) else value for value in column.tolist()], dtype=object)
+    return column.astype(object)
+
+def _float_text(value, precision):
+    """
+    Renders one float with the same rounding as _float_field (half to even on the scaled value, no sign on values
+    that round to zero). NaN and infinities are written as %f writes them
+    """
+    if not math.isfinite(value):
+        return f"%.{precision}f" % value
+    scale = 10 ** precision
+    scaled = int(round(abs(value) * scale))
+    integer_part, decimals = divmod(scaled, scale)
+    text = ("-" if value < 0 and scaled != 0 else "") + str(integer_part)
+    if precision > 0:
+        text += "." + str(decimals).zfill(precision)
+    return text
+
+def _constant(num_rows, char):
+    """
+    Field that holds the same character on every row
+    """
+    return np.full((num_rows, 1), ord(char), dtype=np.uint8)
+
+def _digits(values, width, keep_zeros=False):
+    """
+    Renders non-negative integers as ascii digits, right aligned in width columns
+
+    @param values : np.ndarray  - non-negative integers
+    @param width : int          - number of columns
+    @param keep_zeros : bool    - write leading zeros instead of padding (default: False)
+    @return np.ndarray          - (len(values), width) matrix of bytes
+    """
+    out = np.empty((len(values), width), dtype=np.uint8)
+    remaining = values.copy()
+    for i in range(width - 1, -1, -1):
+        out[:, i] = 48 + remaining % 10
+        if not keep_zeros and i < width - 1:
+            out[remaining == 0, i] = PAD
+        remaining //= 10
+    return out
+
+def _width(values):
+    """
+    Number of digits of the largest of some non-negative integers
+    """
+    return len(str(int(values.max())))
+
+def _int_field(values):
+    """
+    Renders integers as a sign column followed by their digits
+    """
+    magnitude = np.abs(values)
+    sign = np.where(values < 0, ord("-"), PAD).astype(np.uint8)[:, None]
+    return np.hstack([sign, _digits(magnitude, _width(magnitude))])
+
+def _float_field(values, precision):
+    """
+    Renders floats with a fixed number of decimals as a sign column, the integer digits, a point and the decimals
+    """
+    scale = 10 ** precision
+    scaled = np.round(np.abs(values) * scale).astype(np.int64)
+    integer_part = scaled // scale
+    sign = np.where((values < 0) & (scaled != 0), ord("-"), PAD).astype(np.uint8)[:, None]
+    parts = [sign, _digits(integer_part, _width(integer_part))]
+    if precision > 0:
+        parts += [_constant(len(values), "."), _digits(scaled % scale, precision, keep_zeros=True)]
+    return np.hstack(parts)
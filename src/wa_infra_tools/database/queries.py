@@ -0,0 +1,88 @@
+"""
+This file contains builders for the queries used to download datasets
+"""
+
+def dataset_query(images_table_name, labels_table_name, image_id="image_id", filters=None, classes=None, class_column="class_id", sample_percent=None, per_class=None, seed=None):
+    """
+    Builds a single SELECT over the join of an images table and a labels table that applies filters,
+    class selection and sampling on the server. Rows are ordered by image id so all labels of an
+    image are streamed together
+
+    @param images_table_name : str  - table that contains the images (aliased as i in filters)
+    @param labels_table_name : str  - table that contains the labels (aliased as l in filters)
+    @param image_id : str           - column that the two tables will be joined on (default: image_id)
+    @param filters : List[str]      - sql conditions that every row must satisfy (default: None)
+    @param classes : List[any]      - only keep labels of these classes (default: None, keep all classes)
+    @param class_column : str       - column of the labels table containing the class (default: class_id)
+    @param sample_percent : float   - percent of images to sample with TABLESAMPLE BERNOULLI (default: None, all images)
+    @param per_class : int          - keep at most this many images per class, counting each image only for the rarest of
+                                      its classes; picked images keep all of their labels (default: None, no limit)
+    @param seed : int               - seed for sampling, the same seed gives the same sample (default: None, random)
+    @return Tuple[str, List[any]]   - sql string and its parameters
+    """
+    params = []
+
+    tablesample = ""
+    if sample_percent is not None:
+        tablesample = "TABLESAMPLE BERNOULLI (%s)"
+        params.append(sample_percent)
+        if seed is not None:
+            tablesample += " REPEATABLE (%s)"
+            params.append(seed)
+
+    # filters are raw sql, so their % signs must be escaped for the parameters to be substituted
+    conditions = [condition.replace("%", "%%") for condition in filters or []]
+    if classes is not None:
+        conditions.append(f"l.{class_column} = ANY(%s)")
+        params.append(list(classes))
+    where = "WHERE " + " AND ".join(f"({condition})" for condition in conditions) if conditions else ""
+
+    matched = f"""
+        SELECT *
+            FROM {images_table_name} AS i {tablesample}
+            JOIN {labels_table_name} AS l
+            USING ({image_id})
+            {where}
+    """
+    if per_class is None:
+        return matched + f" ORDER BY {image_id}", params
+
+    # each image is assigned to the rarest of its classes (the one with the fewest matched images), so images of
+    # rare classes are not crowded out by common classes such as cars that appear in most of them. The images of
+    # each class are then ranked in a (seeded) random order and the first per_class of them are kept
+    if seed is not None:
+        order = f"md5({image_id}::text || %s)"
+        params.append(str(seed))
+    else:
+        order = "random()"
+    params.append(per_class)
+    sql_string = f"""
+        WITH matched AS ({matched}),
+        image_classes AS (
+            SELECT DISTINCT {image_id}, {class_column} FROM matched
+        ),
+        class_sizes AS (
+            SELECT {class_column}, COUNT(*) AS class_images
+                FROM image_classes
+                GROUP BY {class_column}
+        ),
+        assigned AS (
+            SELECT DISTINCT ON ({image_id}) {image_id}, {class_column}
+                FROM image_classes
+                JOIN class_sizes USING ({class_column})
+                ORDER BY {image_id}, class_images, {class_column}
+        ),
+        picked AS (
+            SELECT {image_id}
+                FROM (
+                    SELECT {image_id}, ROW_NUMBER() OVER (PARTITION BY {class_column} ORDER BY {order}) AS class_rank
+                        FROM assigned
+                ) AS ranked
+                WHERE class_rank <= %s
+        )
+        SELECT *
+            FROM matched
+            WHERE {image_id} IN (SELECT {image_id} FROM picked)
+            ORDER BY {image_id}
+    """
+    return sql_string, params
@@ -0,0 +1,3 @@
+from wa_infra_tools.file_utils.files import cache_dir
+from wa_infra_tools.file_utils.files import link_or_copy
+from wa_infra_tools.file_utils.files import link_tree
@@ -0,0 +1,73 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, where files are hardlinked or copied instead of reflinked
+    fcntl = None
+
+# ioctl that makes a file share the data of another (copy on write) on filesystems with reflinks, e.g. btrfs and xfs
+FICLONE = 0x40049409
+
+def cache_dir(name):
+    """
+    Gets the default location of a local cache of wa_infra_tools (~/.cache/wa_infra_tools/<name> or under XDG_CACHE_HOME)
+
+    @param name : str   - name of the cache, e.g. "images" or "MARS"
+    @return str         - path to the cache
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "wa_infra_tools", name)
+
+def link_or_copy(src_path, dest_path, hardlink=True, protect=False):
+    """
+    Makes src_path appear at dest_path (replacing dest_path) without writing its data again where possible: as a
+    reflink if the filesystem supports them, otherwise as a hardlink, otherwise as a copy
+
+    @param src_path : str   - existing file
+    @param dest_path : str  - where the file should appear
+    @param hardlink : bool  - allow a hardlink, which shares writes with src_path (default: True)
+    @param protect : bool   - make a hardlinked file read-only, so that writing to one copy in place cannot change the
+                              other (default: False)
+    @return str             - how the file was placed ("reflink", "hardlink" or "copy")
+    """
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+    if fcntl is not None:
+        with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                cloned = True
+            except OSError:
+                cloned = False
+        if cloned:
+            shutil.copystat(src_path, dest_path)
+            return "reflink"
+        os.remove(dest_path)
+
+    if hardlink:
+        try:
+            os.link(src_path, dest_path)
+            if protect:
+                os.chmod(dest_path, os.stat(dest_path).st_mode & ~0o222)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(src_path, dest_path)
+    return "copy"
+
+def link_tree(src_dir, dest_dir, hardlink=True, protect=False):
+    """
+    Places every file under src_dir at the same path under dest_dir with link_or_copy, keeping files
+    that are already in dest_dir
+
+    @param src_dir : str    - existing directory
+    @param dest_dir : str   - where its files should appear (created if needed)
+    @param hardlink : bool  - allow hardlinks (default: True)
+    @param protect : bool   - make hardlinked files read-only (default: False)
+    """
+    for dir_path, _, file_names in os.walk(src_dir):
+        dest_path = os.path.join(dest_dir, os.path.relpath(dir_path, src_dir))
+        os.makedirs(dest_path, exist_ok=True)
+        for file_name in file_names:
+            link_or_copy(os.path.join(dir_path, file_name), os.path.join(dest_path, file_name), hardlink, protect)
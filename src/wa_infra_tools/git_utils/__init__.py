@@ -1,6 +1,13 @@
 from wa_infra_tools.git_utils.git import clone
 from wa_infra_tools.git_utils.git import pull 
+from wa_infra_tools.git_utils.git import fetch
+from wa_infra_tools.git_utils.git import reset_to_remote
+from wa_infra_tools.git_utils.git import sparse_checkout
 from wa_infra_tools.git_utils.git import add 
 from wa_infra_tools.git_utils.git import commit 
 from wa_infra_tools.git_utils.git import push 
 from wa_infra_tools.git_utils.git import lfs_pull 
+from wa_infra_tools.git_utils.git import lfs_fetch
+from wa_infra_tools.git_utils.git import lfs_object_paths
+from wa_infra_tools.git_utils.git import ls_tree
+from wa_infra_tools.git_utils.git import TreeEntry
@@ -1,17 +1,124 @@
 import subprocess
 import re
 import os
+import tempfile
+import time
+from collections import namedtuple
 from tqdm import tqdm
 
-def clone(git_url, branch=None, repo_dir=None, capture_output=True):
-    os.environ["GIT_LFS_SKIP_SMUDGE"] = "1"
+# files at most this big are read when listing a tree to find LFS pointers (a pointer is about 130 bytes)
+LFS_POINTER_MAX_SIZE = 1024
+
+# file or directory listed by ls_tree. size is the size stored in git (that of the pointer for LFS files, None for
+# files left out of a partial clone), lfs_oid and lfs_size describe the real file of an LFS pointer (None for other files)
+TreeEntry = namedtuple("TreeEntry", ["path", "type", "oid", "size", "lfs_oid", "lfs_size"])
+
+def clone(git_url, branch=None, repo_dir=None, capture_output=True, bare=False, object_filter=None, sparse_paths=None):
     if repo_dir is None:
         repo_dir = re.split(r"/|\.", git_url)[-2]
-    commands = ["git", "clone", git_url, "-o", repo_dir]
+    commands = ["git", "clone", git_url, repo_dir]
     if branch is not None:
         commands += ["-b", branch]
-    subprocess.run(commands, capture_output=capture_output)
-    os.environ["GIT_LFS_SKIP_SMUDGE"] = "0"
+    if bare: # only the git objects, no working tree
+        commands.append("--bare")
+    if object_filter is not None: # partial clone, e.g. blob:none leaves out every file until it is needed
+        commands.append("--filter=" + object_filter)
+    if sparse_paths is not None: # only the files at the top of the repo are checked out by the clone itself
+        commands.append("--sparse")
+    subprocess.run(commands, capture_output=capture_output, check=True, env=_skip_smudge_env())
+    if sparse_paths:
+        sparse_checkout(repo_dir, sparse_paths, capture_output)
+
+def sparse_checkout(repo_dir, paths, capture_output=True):
+    """
+    Limits the working tree to some directories (cone mode, the files at the top of the repo are always
+    checked out). Files outside of them are removed from the working tree, and in a partial clone the
+    files inside them are fetched in one batch. LFS files are left as pointers
+
+    @param repo_dir : str       - repo to change
+    @param paths : List[str]    - directories to check out (None to check out the whole repo again)
+    """
+    if paths is None:
+        command = ["git", "sparse-checkout", "disable"]
+    else:
+        command = ["git", "sparse-checkout", "set", "--cone", "--"] + list(paths)
+    subprocess.run(command, cwd=repo_dir, capture_output=capture_output, check=True, env=_skip_smudge_env())
+
+def fetch(repo_dir, capture_output=True, refspecs=None):
+    """
+    Downloads the commits of origin that are not in the repo yet (LFS files are not downloaded)
+
+    @param repo_dir : str           - repo to fetch into
+    @param capture_output : bool    - hide the output of git (default: True)
+    @param refspecs : List[str]     - refs to fetch, e.g. "+refs/heads/*:refs/heads/*" to update the branches of a bare
+                                      clone (default: None, the configured refs of origin)
+    """
+    subprocess.run(["git", "fetch", "--prune", "origin"] + (refspecs or []), cwd=repo_dir, capture_output=capture_output, check=True)
+
+def ls_tree(repo_dir, ref="HEAD", paths=None, recursive=True):
+    """
+    Lists files straight from the git objects of ref, so no working tree is needed (the repo can be bare).
+    The small files are read in one batch to pick out LFS pointers and get the size and oid of the real file.
+    In a partial clone nothing is downloaded: files that were left out are listed without a size
+
+    @param repo_dir : str       - repo to read
+    @param ref : str            - branch, tag or commit to list (default: HEAD)
+    @param paths : List[str]    - directories or files to list (default: None, the whole repo)
+    @param recursive : bool     - list every file below paths instead of their direct children (default: True)
+    @return List[TreeEntry]     - listed files (and directories when not recursive)
+    """
+    # ls-tree -l would download every missing file of a partial clone to get its size, so there
+    # the sizes of the files that are present are read separately
+    partial = _is_partial_clone(repo_dir)
+    command = ["git", "ls-tree", "-z"] + ([] if partial else ["-l"]) + (["-r"] if recursive else []) + [ref, "--"] + (paths or [])
+    output = subprocess.run(command, cwd=repo_dir, capture_output=True, check=True).stdout
+    sizes = _present_blob_sizes(repo_dir) if partial else None
+
+    entries = []
+    for record in output.split(b"\0"):
+        if not record:
+            continue
+        info, path = record.split(b"\t", 1)
+        info = info.decode().split()
+        kind, oid = info[1], info[2]
+        if kind != "blob":
+            size = 0
+        elif partial:
+            size = sizes.get(oid)
+        else:
+            size = int(info[3])
+        entries.append(TreeEntry(path.decode(), kind, oid, size, None, None))
+
+    pointers = _read_lfs_pointers(repo_dir, {
+        entry.oid for entry in entries if entry.type == "blob" and entry.size is not None and entry.size <= LFS_POINTER_MAX_SIZE
+    })
+    for i, entry in enumerate(entries):
+        if entry.oid in pointers:
+            lfs_oid, lfs_size = pointers[entry.oid]
+            entries[i] = entry._replace(lfs_oid=lfs_oid, lfs_size=lfs_size)
+    return entries
+
+def reset_to_remote(repo_dir, branch=None, capture_output=True):
+    """
+    Checks out branch exactly as it is on origin, discarding local commits, changes and untracked files.
+    LFS files are left as pointers unless they were already downloaded
+
+    @param repo_dir : str   - repo to reset
+    @param branch : str     - branch to check out (default: default branch of origin)
+    @return str             - branch that was checked out
+    """
+    if branch is None:
+        head = subprocess.run(
+            ["git", "symbolic-ref", "--short", "refs/remotes/origin/HEAD"],
+            cwd=repo_dir, capture_output=True, text=True, check=True
+        )
+        branch = head.stdout.strip().split("/", 1)[1]
+    subprocess.run(
+        ["git", "checkout", "-f", "-B", branch, "--track", "origin/" + branch],
+        cwd=repo_dir, capture_output=capture_output, check=True, env=_skip_smudge_env()
+    )
+    subprocess.run(["git", "clean", "-fdq"], cwd=repo_dir, capture_output=capture_output, check=True)
+    return branch
 
 def pull(repo_dir, capture_output=True):
     cwd = os.getcwd()
@@ -43,8 +150,168 @@ def push(repo_dir, set_upstream=False, capture_output=True):
         subprocess.run(["git", "push"], capture_output=capture_output)
     os.chdir(cwd)
 
-def lfs_pull(repo_dir, includes="", excludes="", capture_output=True):
-    cwd = os.getcwd()
-    os.chdir(repo_dir)
-    subprocess.run(["git", "lfs", "pull", f"-I {includes}", f"-X {excludes}"], capture_output=capture_output)
-    os.chdir(cwd)
+def lfs_pull(repo_dir, includes=None, excludes=None, capture_output=True, concurrent_transfers=16, batch_size=None):
+    """
+    Downloads the LFS files of the checked out commit and replaces their pointers with them. Objects are
+    transferred concurrent_transfers at a time; unless capture_output is set the progress is shown while they arrive
+
+    @param repo_dir : str               - repo to pull into
+    @param includes : List[str]         - paths (or patterns) of the files to pull, a single str is also accepted (default: None, every file)
+    @param excludes : List[str]         - paths (or patterns) of files not to pull (default: None)
+    @param capture_output : bool        - hide the progress (default: True)
+    @param concurrent_transfers : int   - number of objects downloaded at once (default: 16)
+    @param batch_size : int             - number of objects requested from the LFS server per batch request (default: None, git lfs default)
+    @return Dict[str, float]            - number of files and bytes received, seconds taken and MB/s
+    """
+    return _run_lfs_download(repo_dir, "pull", "Pulled", includes, excludes, capture_output, concurrent_transfers, batch_size)
+
+def lfs_fetch(repo_dir, includes=None, excludes=None, capture_output=True, concurrent_transfers=16, batch_size=None):
+    """
+    Downloads the LFS files of the checked out commit into the LFS object store only (see lfs_object_paths),
+    leaving the working tree untouched. Takes the same arguments as lfs_pull
+
+    @return Dict[str, float] - number of files and bytes received, seconds taken and MB/s
+    """
+    return _run_lfs_download(repo_dir, "fetch", "Fetched", includes, excludes, capture_output, concurrent_transfers, batch_size)
+
+def lfs_object_paths(repo_dir, oids):
+    """
+    Gets where git lfs stores objects once they are downloaded (.git/lfs/objects/<aa>/<bb>/<oid>)
+
+    @param repo_dir : str           - repo (or bare repo) the objects are downloaded into
+    @param oids : Iterable[str]     - sha256 of each LFS file (TreeEntry.lfs_oid)
+    @return Dict[str, str]          - oid -> path to the object, which may not exist yet
+    """
+    git_dir = subprocess.run(
+        ["git", "rev-parse", "--git-common-dir"], cwd=repo_dir, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    objects_dir = os.path.join(repo_dir, git_dir, "lfs", "objects")
+    return {oid: os.path.join(objects_dir, oid[:2], oid[2:4], oid) for oid in oids}
+
+def _run_lfs_download(repo_dir, subcommand, action, includes, excludes, capture_output, concurrent_transfers, batch_size):
+    """
+    Runs git lfs pull or fetch, showing its progress, and prints and returns its throughput (see lfs_pull)
+    """
+    command = ["git", "-c", f"lfs.concurrenttransfers={concurrent_transfers}"]
+    if batch_size is not None:
+        command += ["-c", f"lfs.transfer.batchSize={batch_size}"]
+    command += ["lfs", subcommand]
+    # every pattern goes in one comma separated argument, the flag and its value are separate arguments
+    if includes:
+        command += ["-I", includes if isinstance(includes, str) else ",".join(includes)]
+    if excludes:
+        command += ["-X", excludes if isinstance(excludes, str) else ",".join(excludes)]
+
+    # git lfs appends a line to the GIT_LFS_PROGRESS file whenever an object makes progress
+    progress_fd, progress_path = tempfile.mkstemp(prefix="lfs-progress-")
+    os.close(progress_fd)
+    received = {}
+    start_time = time.time()
+    try:
+        with tempfile.TemporaryFile() as stderr, open(progress_path) as progress_file, \
+                tqdm(unit="B", unit_scale=True, disable=capture_output) as progress:
+            process = subprocess.Popen(
+                command, cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=stderr,
+                env=dict(os.environ, GIT_LFS_PROGRESS=progress_path)
+            )
+            partial_line = ""
+            while True:
+                finished = process.poll() is not None
+                lines = (partial_line + progress_file.read()).split("\n")
+                partial_line = lines.pop()
+                for line in lines:
+                    _update_lfs_progress(line, received, progress)
+                if finished:
+                    break
+                time.sleep(0.1)
+
+            stderr.seek(0)
+            errors = stderr.read().decode(errors="replace")
+    finally:
+        os.remove(progress_path)
+    if process.returncode != 0:
+        print(errors)
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    num_bytes = sum(received.values())
+    seconds = max(time.time() - start_time, 1e-6)
+    mb_per_sec = num_bytes / 1e6 / seconds
+    if not capture_output:
+        print(f"{action} {len(received)} LFS files ({num_bytes / 1e6:.1f} MB) in {seconds:.1f}s ({mb_per_sec:.2f} MB/s)")
+    return {"files": len(received), "bytes": num_bytes, "seconds": seconds, "mb_per_sec": mb_per_sec}
+
+
+def _update_lfs_progress(line, received, progress):
+    """
+    Parses a line of the GIT_LFS_PROGRESS file ("<direction> <file>/<files> <bytes so far>/<bytes> <name>")
+    and moves the progress bar by the bytes received since the last line about the same file
+    """
+    fields = line.split(" ", 3)
+    if len(fields) != 4:
+        return
+    _, files, byte_counts, name = fields
+    num_bytes = int(byte_counts.split("/")[0])
+    progress.update(num_bytes - received.get(name, 0))
+    received[name] = num_bytes
+    progress.set_postfix_str(f"file {files}")
+
+def _skip_smudge_env():
+    """
+    Environment for git commands that check out files, telling git lfs to leave LFS files as pointers
+    """
+    return dict(os.environ, GIT_LFS_SKIP_SMUDGE="1")
+
+def _is_partial_clone(repo_dir):
+    """
+    Checks whether the repo was cloned with a filter, so some of its objects may be missing
+    """
+    config = subprocess.run(["git", "config", "--get", "remote.origin.promisor"], cwd=repo_dir, capture_output=True, text=True)
+    return config.stdout.strip() == "true"
+
+def _present_blob_sizes(repo_dir):
+    """
+    Gets the size of every file (blob) that is in the repo, without fetching missing ones
+
+    @return Dict[str, int] - blob oid -> size
+    """
+    output = subprocess.run(
+        ["git", "cat-file", "--batch-all-objects", "--batch-check=%(objecttype) %(objectname) %(objectsize)"],
+        cwd=repo_dir, capture_output=True, text=True, check=True
+    ).stdout
+    sizes = {}
+    for line in output.splitlines():
+        kind, oid, size = line.split()
+        if kind == "blob":
+            sizes[oid] = int(size)
+    return sizes
+
+def _read_lfs_pointers(repo_dir, oids):
+    """
+    Reads blobs with a single git cat-file process and parses the ones that are LFS pointers
+
+    @return Dict[str, Tuple[str, int]] - blob oid -> (oid, size) of the LFS object it points to
+    """
+    if not oids:
+        return {}
+    output = subprocess.run(
+        ["git", "cat-file", "--batch"],
+        cwd=repo_dir, input="".join(oid + "\n" for oid in oids).encode(), capture_output=True, check=True
+    ).stdout
+
+    pointers = {}
+    position = 0
+    while position < len(output):
+        header_end = output.index(b"\n", position)
+        header = output[position:header_end].decode().split()
+        if header[1] == "missing":
+            position = header_end + 1
+            continue
+        size = int(header[2])
+        content = output[header_end + 1:header_end + 1 + size]
+        position = header_end + 1 + size + 1
+        if not content.startswith(b"version https://git-lfs.github.com/spec/"):
+            continue
+        fields = dict(line.split(" ", 1) for line in content.decode().splitlines() if " " in line)
+        if fields.get("oid", "").startswith("sha256:") and "size" in fields:
+            pointers[header[0]] = (fields["oid"][len("sha256:"):], int(fields["size"]))
+    return pointers
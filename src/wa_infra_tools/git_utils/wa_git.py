@@ -16,7 +16,9 @@ def parse_args():
     clone_parser.add_argument("git_url", type=str, help="git url of repo to clone")
     clone_parser.add_argument("-b", "--branch", type=str, help="branch to check out (default: remote repo's default branch)")
     clone_parser.add_argument("-o", "--output", type=str, help="where to clone the directory (default: repo name)")
-    clone_parser.set_defaults(func=lambda args: git_utils.clone(args.git_url, args.branch, args.output, False))
+    clone_parser.add_argument("--filter", type=str, help="partial clone filter, e.g. blob:none to only download files when they are checked out")
+    clone_parser.add_argument("--sparse", nargs="*", help="only check out these directories (and the files at the top of the repo)")
+    clone_parser.set_defaults(func=lambda args: git_utils.clone(args.git_url, args.branch, args.output, False, object_filter=args.filter, sparse_paths=args.sparse))
 
     # pull
     pull_parser = subparsers.add_parser(
@@ -58,9 +60,11 @@ def parse_args():
             description="wa_git lfs-pull parser",
             help="pulls latest LFS files")
 
-    lfs_pull_parser.add_argument("-I", "--include", type=str, default="", help="directories to include in the lfs pull")
-    lfs_pull_parser.add_argument("-X", "--exclude", type=str, default="", help="directories to exclude in the lfs pull")
-    lfs_pull_parser.set_defaults(func=lambda args: git_utils.lfs_pull(cwd, args.include, args.exclude, False))
+    lfs_pull_parser.add_argument("-I", "--include", nargs="*", help="directories to include in the lfs pull")
+    lfs_pull_parser.add_argument("-X", "--exclude", nargs="*", help="directories to exclude in the lfs pull")
+    lfs_pull_parser.add_argument("-j", "--concurrent-transfers", type=int, default=16, help="number of files downloaded at once")
+    lfs_pull_parser.add_argument("--batch-size", type=int, help="number of files requested from the LFS server at once (default: git lfs default)")
+    lfs_pull_parser.set_defaults(func=lambda args: git_utils.lfs_pull(cwd, args.include, args.exclude, False, args.concurrent_transfers, args.batch_size))
 
     args = parent_parser.parse_args()
     return args
@@ -1,7 +1,13 @@
 from wa_infra_tools.mars_utils.mars import clone_mars
+from wa_infra_tools.mars_utils.mars import mars_repo
+from wa_infra_tools.mars_utils.mars import clear_cache
 from wa_infra_tools.mars_utils.mars import download 
 from wa_infra_tools.mars_utils.mars import upload 
 from wa_infra_tools.mars_utils.mars import remove 
 from wa_infra_tools.mars_utils.mars import list_files
+from wa_infra_tools.mars_utils.mars import list_tree
+from wa_infra_tools.mars_utils.mars import summarize_tree
+from wa_infra_tools.mars_utils.mars import describe_group
+from wa_infra_tools.mars_utils.mars import mars_index
 from wa_infra_tools.mars_utils import models
 from wa_infra_tools.mars_utils import rosbags 
@@ -1,90 +1,264 @@
 from wa_infra_tools import git_utils
-from distutils.dir_util import copy_tree, remove_tree
+from wa_infra_tools import file_utils
+from distutils.dir_util import remove_tree
+from collections import Counter
+import contextlib
 import os
+import posixpath
+import shutil
+import subprocess
+import time
 
-def clone_mars(branch=None, mars_dir=None, capture_output=True):
+try:
+    import fcntl
+except ImportError: # Windows, where the cache is locked with msvcrt instead
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+MARS_URLS = ["git@github.com:WisconsinAutonomous/MARS.git", "https://github.com/WisconsinAutonomous/MARS.git"]
+
+# the cached repos are partial clones without files over 1 MB (in MARS those are stored in LFS). Unlike
+# blob:none this keeps every LFS pointer, which git lfs reads from the whole tree
+MARS_FILTER = "blob:limit=1m"
+
+def clone_mars(branch=None, mars_dir=None, capture_output=True, **kwargs):
     try:
-        git_utils.clone("git@github.com:WisconsinAutonomous/MARS.git", branch, mars_dir, capture_output)
+        git_utils.clone(MARS_URLS[0], branch, mars_dir, capture_output, **kwargs)
         return
-    except:
+    except subprocess.CalledProcessError:
         print("ssh clone of MARS failed")
 
     try:
-        git_utils.clone("https://github.com/WisconsinAutonomous/MARS.git", branch, mars_dir, capture_output)
+        git_utils.clone(MARS_URLS[1], branch, mars_dir, capture_output, **kwargs)
         return
-    except:
+    except subprocess.CalledProcessError:
         print("https clone of MARS failed")
+        raise
+
+def default_cache_dir():
+    """
+    Gets the default location of the cached MARS repo (~/.cache/wa_infra_tools/MARS or under XDG_CACHE_HOME)
+    """
+    return file_utils.cache_dir("MARS")
+
+@contextlib.contextmanager
+def mars_repo(mars_dir=None, branch=None, cache_dir=None, paths=None):
+    """
+    Gives the MARS repo to work in for the duration of the block: mars_dir if it is given, otherwise the
+    cached repo, which is cloned the first time (as a partial clone) and afterwards only fetches new commits.
+    The cached repo is reset to branch as it is on GitHub, with only paths checked out (sparse checkout), and
+    locked so that concurrent wa-mars commands wait for each other
+
+        with mars_repo(paths=["models/yolo"]) as mars_dir:
+            print(os.listdir(mars_dir + "/models/yolo"))
+
+    @param mars_dir : str       - existing MARS repo to use as is (default: None, use the cache)
+    @param branch : str         - branch to check out in the cache (default: default branch of MARS)
+    @param cache_dir : str      - where the cached repo is kept (default: ~/.cache/wa_infra_tools/MARS)
+    @param paths : List[str]    - directories to check out in the cache (default: None, the whole repo)
+    @return str                 - path to the repo
+    """
+    if mars_dir is not None:
+        yield mars_dir
+        return
+
+    cache_dir = cache_dir or default_cache_dir()
+    with _locked(cache_dir):
+        if os.path.isdir(os.path.join(cache_dir, ".git")):
+            git_utils.fetch(cache_dir)
+        else:
+            if os.path.exists(cache_dir): # left behind by an interrupted clone
+                shutil.rmtree(cache_dir)
+            print("Cloning MARS into", cache_dir)
+            clone_mars(branch=branch, mars_dir=cache_dir, object_filter=MARS_FILTER, sparse_paths=[])
+        # narrowed before moving to the new commit so that only files in paths are fetched
+        git_utils.sparse_checkout(cache_dir, paths)
+        git_utils.reset_to_remote(cache_dir, branch)
+        yield cache_dir
+
+@contextlib.contextmanager
+def mars_index(cache_dir=None):
+    """
+    Gives a bare partial clone of MARS that is only used to list files, fetching new commits first (locked like
+    mars_repo). It has no working tree and holds only commits, trees and files up to 1 MB (such as LFS pointers)
+
+    @param cache_dir : str  - where the cached repo is kept, the index is kept next to it (default: ~/.cache/wa_infra_tools/MARS)
+    @return str             - path to the bare repo
+    """
+    index_dir = (cache_dir or default_cache_dir()) + ".git"
+    with _locked(index_dir):
+        if os.path.isfile(os.path.join(index_dir, "HEAD")):
+            git_utils.fetch(index_dir, refspecs=["+refs/heads/*:refs/heads/*"])
+        else:
+            if os.path.exists(index_dir): # left behind by an interrupted clone
+                shutil.rmtree(index_dir)
+            clone_mars(mars_dir=index_dir, bare=True, object_filter=MARS_FILTER)
+        yield index_dir
+
+def clear_cache(cache_dir=None):
+    """
+    Deletes the cached MARS repo (including downloaded LFS files) and listing index, waiting for commands using them to finish
+
+    @param cache_dir : str - where the cached repo is kept (default: ~/.cache/wa_infra_tools/MARS)
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    for repo_dir in [cache_dir, cache_dir + ".git"]:
+        if not os.path.exists(repo_dir + ".lock"):
+            continue
+        with _locked(repo_dir):
+            if os.path.exists(repo_dir):
+                shutil.rmtree(repo_dir)
+
+@contextlib.contextmanager
+def _locked(repo_dir):
+    """
+    Holds an exclusive lock on a cached repo (a lock file next to it) for the duration of the block.
+    On platforms with neither flock nor msvcrt the cache is used without a lock
+    """
+    os.makedirs(os.path.dirname(repo_dir), exist_ok=True)
+    with open(repo_dir + ".lock", "w") as lock_file:
+        if not _lock_file(lock_file, blocking=False):
+            print("Waiting for another command using the MARS cache to finish")
+            _lock_file(lock_file, blocking=True)
+        try:
+            yield
+        finally:
+            if fcntl is None and msvcrt is not None:
+                # msvcrt locks are not guaranteed to be released as soon as the file is closed
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _lock_file(lock_file, blocking):
+    """
+    Takes an exclusive lock on an open lock file, with flock or (on Windows) on its first byte with msvcrt
+
+    @param lock_file : file - lock file opened for writing
+    @param blocking : bool  - wait until the lock is free instead of giving up
+    @return bool            - whether the lock was taken
+    """
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            return True
+        except BlockingIOError:
+            return False
+    if msvcrt is None:
+        return True
+    while True:
+        try:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(1)
 
 def upload(source_path, upload_path, mars_dir=None, branch=None, commit_message=None, commit_changes=True, push_changes=True):
-    del_mars = False # delete mars repo after operation
-    if mars_dir is None: # create temporary repo
-        clone_mars(branch=branch)
-        mars_dir = "MARS"
-        del_mars = True
-
-    # upload files
-    dest_path = mars_dir + "/" + upload_path
-    os.makedirs(dest_path, exist_ok=True)
-    copy_tree(source_path, dest_path)
-    git_utils.add(mars_dir, [upload_path], capture_output=False)
-    if commit_changes:
-        git_utils.commit(mars_dir, commit_message, capture_output=False)
-        if push_changes:
-            git_utils.push(mars_dir, capture_output=False)
-
-    # delete temp repo
-    if del_mars:
-        remove_tree(mars_dir)
+    with mars_repo(mars_dir, branch, paths=[upload_path]) as repo_dir:
+        # upload files. They are linked into the repo instead of copied, git lfs only reads them to store them.
+        # Only the cache gets hardlinks, the next command replaces them there before anything can write to them
+        file_utils.link_tree(source_path, repo_dir + "/" + upload_path, hardlink=mars_dir is None)
+        git_utils.add(repo_dir, [upload_path], capture_output=False)
+        if commit_changes:
+            git_utils.commit(repo_dir, commit_message, capture_output=False)
+            if push_changes:
+                git_utils.push(repo_dir, capture_output=False)
 
 
 def download(local_path, output_dir, mars_dir=None, branch=None):
-    del_mars = False # delete mars repo after operation
-    if mars_dir is None: # create temporary repo
-        clone_mars(branch=branch)
-        mars_dir = "MARS"
-        del_mars = True
-
-    # pull files
-    git_utils.pull(mars_dir, capture_output=False)
-    git_utils.lfs_pull(mars_dir, includes=local_path, capture_output=False)
-    src_path = mars_dir + "/"  + local_path
-    copy_tree(src_path, output_dir)
-
-    # delete temp repo
-    if del_mars:
-        remove_tree(mars_dir)
+    with mars_repo(mars_dir, branch, paths=[local_path]) as repo_dir:
+        # pull files (the cached repo is already up to date)
+        if mars_dir is not None:
+            git_utils.pull(repo_dir, capture_output=False)
+        # LFS files are only downloaded into the LFS object store and placed in output_dir straight from there,
+        # so their data is written once instead of being checked out into the repo and copied again
+        git_utils.lfs_fetch(repo_dir, includes=[local_path], capture_output=False)
+        entries = [entry for entry in git_utils.ls_tree(repo_dir, "HEAD", [local_path + "/"]) if entry.type == "blob"]
+        if not entries:
+            raise FileNotFoundError(f"{local_path} is not in MARS")
+        object_paths = git_utils.lfs_object_paths(repo_dir, {entry.lfs_oid for entry in entries if entry.lfs_oid is not None})
+
+        placed = Counter()
+        for entry in entries:
+            dest_path = os.path.join(output_dir, posixpath.relpath(entry.path, local_path))
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            if entry.lfs_oid is not None:
+                # a hardlinked object is made read-only, writing to it would corrupt every later download of it
+                placed[file_utils.link_or_copy(object_paths[entry.lfs_oid], dest_path, protect=True)] += 1
+            else:
+                placed[file_utils.link_or_copy(repo_dir + "/" + entry.path, dest_path, hardlink=False)] += 1
+        print(f"Placed {len(entries)} files in {output_dir} ({placed['reflink']} reflinked, {placed['hardlink']} hardlinked, {placed['copy']} copied)")
 
 def remove(local_path, mars_dir=None, branch=None, commit_message=None, commit_changes=True, push_changes=True):
-    del_mars = False # delete mars repo after operation
-    if mars_dir is None: # create temporary repo
-        clone_mars(branch=branch)
-        mars_dir = "MARS"
-        del_mars = True
-
-    # remove files
-    remove_tree(mars_dir + "/" + local_path)
-    git_utils.add(mars_dir, [local_path], capture_output=False)
-    if commit_changes:
-        git_utils.commit(mars_dir, commit_message, capture_output=False)
-        if push_changes:
-            git_utils.push(mars_dir, capture_output=False)
-
-    # delete temp repo
-    if del_mars:
-        remove_tree(mars_dir)
+    with mars_repo(mars_dir, branch, paths=[local_path]) as mars_dir:
+        # remove files
+        remove_tree(mars_dir + "/" + local_path)
+        git_utils.add(mars_dir, [local_path], capture_output=False)
+        if commit_changes:
+            git_utils.commit(mars_dir, commit_message, capture_output=False)
+            if push_changes:
+                git_utils.push(mars_dir, capture_output=False)
 
 def list_files(local_path, mars_dir=None, branch=None):
-    del_mars = False # delete mars repo after operation
-    if mars_dir is None: # create temporary repo
-        clone_mars(branch=branch)
-        mars_dir = "MARS"
-        del_mars = True
+    if mars_dir is not None:
+        # create list of files in directory
+        return os.listdir(mars_dir + "/" + local_path)
+    return [posixpath.basename(entry.path) for entry in list_tree(local_path, branch=branch, recursive=False)]
+
+def list_tree(local_path, mars_dir=None, branch=None, recursive=True):
+    """
+    Lists the files under local_path in one call without checking anything out, from the listing index
+    (or the committed state of mars_dir). LFS files are listed with the size and oid of the real file
+
+    @param local_path : str     - directory in MARS, e.g. "models" or "rosbags/<name>"
+    @param mars_dir : str       - existing MARS repo to read instead of the index (default: None)
+    @param branch : str         - branch to list (default: the checked out branch of mars_dir, or the default branch of MARS)
+    @param recursive : bool     - list every file below local_path instead of its direct children (default: True)
+    @return List[TreeEntry]     - listed files, with paths relative to the root of MARS
+    """
+    ref = branch or "HEAD"
+    if mars_dir is not None:
+        return git_utils.ls_tree(mars_dir, ref, [local_path + "/"], recursive)
+    with mars_index() as index_dir:
+        return git_utils.ls_tree(index_dir, ref, [local_path + "/"], recursive)
 
-    # create list of files in directory
-    files = os.listdir(mars_dir + "/" + local_path)
+def summarize_tree(entries, local_path, depth):
+    """
+    Groups listed files by the directories depth levels below local_path, e.g. depth 2 below "models" gives
+    one group per <category>/<model>. Files over 1 MB that are not in LFS are left out of the partial clones,
+    so their size is unknown: they are counted separately instead of being added to the total
 
-    # delete temp repo
-    if del_mars:
-        remove_tree(mars_dir)
+    @param entries : List[TreeEntry]            - files listed by list_tree
+    @param local_path : str                     - directory that was listed
+    @param depth : int                          - number of path components that name a group
+    @return List[Tuple[str, int, int, int]]     - name, number of files, total size of the files of known size (of the
+                                                  real files for LFS) and number of files of unknown size of each group
+    """
+    groups = {}
+    for entry in entries:
+        if entry.type != "blob":
+            continue
+        parts = posixpath.relpath(entry.path, local_path).split("/")
+        if len(parts) <= depth: # a file where a group directory was expected
+            continue
+        name = "/".join(parts[:depth])
+        num_files, num_bytes, num_unknown = groups.get(name, (0, 0, 0))
+        size = entry.lfs_size if entry.lfs_oid is not None else entry.size
+        if size is None:
+            groups[name] = (num_files + 1, num_bytes, num_unknown + 1)
+        else:
+            groups[name] = (num_files + 1, num_bytes + size, num_unknown)
+    return [(name, *group) for name, group in sorted(groups.items())]
 
-    return files
+def describe_group(num_files, num_bytes, num_unknown):
+    """
+    Formats the number of files and size of a group from summarize_tree, e.g. "3 files, 12.5 MB" or
+    "3 files, at least 12.5 MB, 1 of unknown size"
+    """
+    if num_unknown:
+        return f"{num_files} files, at least {num_bytes / 1e6:.1f} MB, {num_unknown} of unknown size"
+    return f"{num_files} files, {num_bytes / 1e6:.1f} MB"
@@ -1,4 +1,4 @@
-from wa_infra_tools.mars_utils import download, upload, remove, list_files
+from wa_infra_tools.mars_utils import download, upload, remove, list_tree, summarize_tree, describe_group
 import subprocess
 
 def upload_model(model_name, category, model_dir, mars_dir=None, branch=None, commit_message=None, commit_changes=True, push_changes=True):
@@ -17,8 +17,8 @@ def remove_model(model_name, category, mars_dir=None, branch=None, commit_messag
     remove(del_path, mars_dir, branch, commit_message, commit_changes, push_changes)
 
 def list_models(categories=None, mars_dir=None, branch=None):
-    if categories is None:
-        categories = list_files("models", mars_dir, branch)
-    for category in categories:
-        for model in list_files("models/" + category, mars_dir, branch):
-            print(category + "/" + model)
+    # every model of every category is listed in one call, without checking anything out
+    entries = list_tree("models", mars_dir, branch)
+    for name, num_files, num_bytes, num_unknown in summarize_tree(entries, "models", 2):
+        if categories is None or name.split("/")[0] in categories:
+            print(f"{name}  ({describe_group(num_files, num_bytes, num_unknown)})")
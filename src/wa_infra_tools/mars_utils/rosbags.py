@@ -1,4 +1,4 @@
-from wa_infra_tools.mars_utils import clone_mars, download, upload, remove, list_files
+from wa_infra_tools.mars_utils import clone_mars, download, upload, remove, list_tree, summarize_tree, describe_group
 import subprocess
 
 def record_rosbag(topics=None, upload=False, output_dir=None, mars_dir=None, branch=None, commit_message=None, commit_changes=True, push_changes=True):
@@ -23,10 +23,10 @@ def upload_rosbag(rosbag_name, rosbag_dir, mars_dir=None, branch=None, commit_me
     upload_path = "rosbags/" + rosbag_name
     if commit_message is None:
         commit_message = "Uploaded rosbag {rosbag_name}"
-    upload(rosbag_dir, upload_path, mars_dir, commit_message, commit_changes, push_changes)
+    upload(rosbag_dir, upload_path, mars_dir, branch, commit_message, commit_changes, push_changes)
 
 def download_rosbag(rosbag_name, output_dir, mars_dir=None, branch=None):
-    download("rosbags/" + rosbag_name, output_dir, mars_dir)
+    download("rosbags/" + rosbag_name, output_dir, mars_dir, branch)
 
 def remove_rosbag(rosbag_name, mars_dir=None, branch=None, commit_message=None, commit_changes=True, push_changes=True):
     del_path = "rosbags/" + rosbag_name
@@ -35,5 +35,6 @@ def remove_rosbag(rosbag_name, mars_dir=None, branch=None, commit_message=None,
     remove(del_path, mars_dir, branch, commit_message, commit_changes, push_changes)
 
 def list_rosbags(mars_dir=None, branch=None):
-    for rosbag in list_files("rosbags", mars_dir, branch):
-        print(rosbag)
+    entries = list_tree("rosbags", mars_dir, branch)
+    for rosbag, num_files, num_bytes, num_unknown in summarize_tree(entries, "rosbags", 1):
+        print(f"{rosbag}  ({describe_group(num_files, num_bytes, num_unknown)})")
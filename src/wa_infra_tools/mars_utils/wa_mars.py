@@ -20,7 +20,7 @@ def parse_args():
     upload_model_parser.add_argument("model_name", type=str, help="name of the model to upload")
     upload_model_parser.add_argument("category", type=str, help="category of model")
     upload_model_parser.add_argument("model_dir", type=str, help="where the model is currently stored")
-    upload_model_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    upload_model_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     upload_model_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     upload_model_parser.add_argument("-m", "--message", type=str, help="commit message")
     upload_model_parser.add_argument("--no-commit", action="store_false", help="do not commit changes")
@@ -34,7 +34,7 @@ def parse_args():
     download_model_parser.add_argument("model_name", type=str, help="name of the model to download")
     download_model_parser.add_argument("category", type=str, help="category of model")
     download_model_parser.add_argument("output_dir", type=str, help="where to save the model")
-    download_model_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    download_model_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     download_model_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     download_model_parser.set_defaults(func=lambda args: mars_utils.models.download_model(args.model_name, args.category, args.output_dir, args.mars_dir, args.branch))
 
@@ -44,7 +44,7 @@ def parse_args():
             help="remove models in MARS")
     remove_model_parser.add_argument("model_name", type=str, help="name of the model to remove")
     remove_model_parser.add_argument("category", type=str, help="category of model")
-    remove_model_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    remove_model_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     remove_model_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     remove_model_parser.add_argument("-m", "--message", type=str, help="commit message")
     remove_model_parser.add_argument("--no-commit", action="store_false", help="do not commit changes")
@@ -56,7 +56,7 @@ def parse_args():
             description="wa_mars model list parser",
             help="list models in MARS")
     list_models_parser.add_argument("-c", "--categories", nargs="*", help="category of models you want listed (default: list all categories)")
-    list_models_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    list_models_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     list_models_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     list_models_parser.set_defaults(func=lambda args: mars_utils.models.list_models(args.categories, args.mars_dir, args.branch))
 
@@ -74,7 +74,7 @@ def parse_args():
     record_rosbag_parser.add_argument("topics", nargs="*", help="list of topics to record")
     record_rosbag_parser.add_argument("-u", "--upload", action="store_true", help="upload rosbag to MARS (only done if output dir (rosbag name) is specified)")
     record_rosbag_parser.add_argument("-o", "--output", type=str, help="name of the directory to save the rosbag into")
-    record_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    record_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     record_rosbag_parser.add_argument("-b", "--branch", type=str, help="which MARS branch to upload to")
     record_rosbag_parser.add_argument("-m", "--message", type=str, help="commit message")
     record_rosbag_parser.add_argument("--no-commit", action="store_false", help="do not commit changes")
@@ -87,7 +87,7 @@ def parse_args():
             help="upload a rosbag to MARS")
     upload_rosbag_parser.add_argument("rosbag_name", type=str, help="name of the rosbag to upload")
     upload_rosbag_parser.add_argument("rosbag_dir", type=str, help="where the rosbag is currently stored")
-    upload_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    upload_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     upload_rosbag_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     upload_rosbag_parser.add_argument("-m", "--message", type=str, help="commit message")
     upload_rosbag_parser.add_argument("--no-commit", action="store_false", help="do not commit changes")
@@ -101,7 +101,7 @@ def parse_args():
 
     download_rosbag_parser.add_argument("rosbag_name", type=str, help="name of the rosbag to download")
     download_rosbag_parser.add_argument("output_dir", type=str, help="where to save the rosbag")
-    download_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    download_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     download_rosbag_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     download_rosbag_parser.set_defaults(func=lambda args: mars_utils.rosbags.download_rosbag(args.rosbag_name, args.output_dir, args.mars_dir, args.branch))
 
@@ -110,7 +110,7 @@ def parse_args():
             description="wa_mars rosbag remove parser",
             help="remove rosbags in MARS")
     remove_rosbag_parser.add_argument("rosbag_name", type=str, help="name of the rosbag to remove")
-    remove_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    remove_rosbag_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     remove_rosbag_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     remove_rosbag_parser.add_argument("-m", "--message", type=str, help="commit message")
     remove_rosbag_parser.add_argument("--no-commit", action="store_false", help="do not commit changes")
@@ -121,10 +121,23 @@ def parse_args():
             "list",
             description="wa_mars rosbag list parser",
             help="list rosbags in MARS")
-    list_rosbags_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: crate a temporary MARS repo)")
+    list_rosbags_parser.add_argument("--mars-dir", type=str, help="where the MARS repo is (default: the cached MARS repo in ~/.cache/wa_infra_tools)")
     list_rosbags_parser.add_argument("-b", "--branch", type=str, help="which branch of MARS to check out")
     list_rosbags_parser.set_defaults(func=lambda args: mars_utils.rosbags.list_rosbags(args.mars_dir, args.branch))
 
+    # cache
+    cache_parser = subparsers.add_parser(
+            "cache",
+            description="wa_mars cache entrypoint",
+            help="entrypoint to commands managing the cached MARS repo")
+    cache_subparsers = cache_parser.add_subparsers(title="commands")
+
+    clear_cache_parser = cache_subparsers.add_parser(
+            "clear",
+            description="wa_mars cache clear parser",
+            help="delete the cached MARS repo and the LFS files downloaded into it")
+    clear_cache_parser.set_defaults(func=lambda args: mars_utils.clear_cache())
+
     args = parent_parser.parse_args()
     return args
 
@@ -0,0 +1,264 @@
+"""
+This file contains the Relay class which copies data between local sockets and
+SSH channels for every forwarded connection on a single event loop thread
+"""
+import paramiko
+import selectors
+import socket
+import threading
+
+# errors of a socket or channel (a channel of a lost transport raises EOFError) that end its connection
+CONNECTION_ERRORS = (OSError, EOFError, paramiko.SSHException)
+
+# seconds between retries of writes that are waiting for the SSH channel window to open
+WINDOW_POLL_INTERVAL = 0.005
+
+class Relay:
+    def __init__(self, buffer_size=256 * 1024):
+        """
+        Constructs a Relay object. Its event loop thread is started when the first connection is added
+
+        @param buffer_size : int - bytes read at once in each direction of a connection (default: 256 KiB)
+        """
+        self.buffer_size = buffer_size
+        self.selector = selectors.DefaultSelector()
+        self.pipes = set()
+
+        # added connections are handed to the event loop thread, which is woken up through this socket pair
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+        self._added = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def add(self, sock, channel):
+        """
+        Starts relaying data between a local socket and an SSH channel. Both are closed by the relay
+        once both sides have finished sending or an error occurs
+
+        @param sock : socket.socket     - accepted local connection
+        @param channel : paramiko.Channel - channel opened for the connection
+        """
+        with self._lock:
+            self._added.append(_Pipe(self, sock, channel))
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._loop, name="relay", daemon=True)
+                self._thread.start()
+        self._wakeup_send.send(b"\0")
+
+    def close(self):
+        """
+        Stops the event loop and closes every connection
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._running = False
+        self._wakeup_send.send(b"\0")
+        if thread is not None:
+            thread.join()
+        for pipe in list(self.pipes):
+            pipe.close()
+
+    def _loop(self):
+        """
+        Event loop: waits until a socket or channel is ready and moves data for it. While a pipe is waiting
+        for the window of its channel (which has no file descriptor to wait on) the loop polls it
+        """
+        while self._running:
+            waiting = [pipe for pipe in self.pipes if pipe.waiting_for_window]
+            events = self.selector.select(WINDOW_POLL_INTERVAL if waiting else None)
+            for key, mask in events:
+                if key.data is None:
+                    self._accept_added()
+                    continue
+                pipe, side = key.data
+                pipe.ready(side, mask)
+            for pipe in waiting:
+                pipe.flush_up()
+
+    def _accept_added(self):
+        """
+        Registers the connections added since the loop last woke up
+        """
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            added, self._added = self._added, []
+        for pipe in added:
+            self.pipes.add(pipe)
+            pipe.update()
+
+class _Pipe:
+    """
+    Both directions of one forwarded connection. Data read from the socket is sent to the channel
+    (up) and data received on the channel is written to the socket (down). A side is only read
+    while what was last read from it has been completely written to the other side, so a slow
+    reader on either end holds back the writer instead of growing a buffer
+    """
+    def __init__(self, relay, sock, channel):
+        self.relay = relay
+        self.sock = sock
+        self.channel = channel
+        self.peername = sock.getpeername()
+        sock.setblocking(False)
+        channel.setblocking(False)
+
+        self.up_buffer = bytearray(relay.buffer_size)
+        self.up_view = memoryview(self.up_buffer)
+        self.up_start = self.up_end = 0
+        self.down_view = None
+        self.down_start = 0
+
+        self.sock_eof = False
+        self.channel_eof = False
+        self.waiting_for_window = False
+        self.closed = False
+        self.registered = {}
+
+    def ready(self, side, mask):
+        """
+        Handles a readiness event of the socket or the channel
+        """
+        try:
+            if side == "sock":
+                if mask & selectors.EVENT_WRITE:
+                    self.flush_down()
+                if mask & selectors.EVENT_READ and not self.closed:
+                    self.read_sock()
+            else:
+                self.read_channel()
+        except CONNECTION_ERRORS:
+            self.close()
+            return
+        self.update()
+
+    def read_sock(self):
+        """
+        Reads from the socket into the reusable up buffer and sends it to the channel
+        """
+        if self.up_start < self.up_end:
+            return
+        try:
+            num_bytes = self.sock.recv_into(self.up_buffer)
+        except BlockingIOError:
+            return
+        if num_bytes == 0:
+            self.sock_eof = True
+            self.channel.shutdown_write()
+            return
+        self.up_start, self.up_end = 0, num_bytes
+        self.flush_up()
+
+    def flush_up(self):
+        """
+        Sends as much of the up buffer as the channel window allows
+        """
+        if self.closed:
+            return
+        try:
+            while self.up_start < self.up_end:
+                if not self.channel.send_ready():
+                    self.waiting_for_window = True
+                    return
+                self.up_start += self.channel.send(self.up_view[self.up_start:self.up_end])
+        except CONNECTION_ERRORS:
+            self.close()
+            return
+        if self.waiting_for_window:
+            self.waiting_for_window = False
+            self.update()
+
+    def read_channel(self):
+        """
+        Receives from the channel and writes it to the socket
+        """
+        if self.down_view is not None:
+            return
+        if not self.channel.recv_ready():
+            if self.channel.closed or self.channel.eof_received:
+                self.channel_eof = True
+                self.sock.shutdown(socket.SHUT_WR)
+            return
+        data = self.channel.recv(self.relay.buffer_size)
+        if not data:
+            self.channel_eof = True
+            self.sock.shutdown(socket.SHUT_WR)
+            return
+        self.down_view = memoryview(data)
+        self.down_start = 0
+        self.flush_down()
+
+    def flush_down(self):
+        """
+        Writes as much of the data received on the channel as the socket accepts
+        """
+        if self.down_view is None:
+            return
+        try:
+            while self.down_start < len(self.down_view):
+                self.down_start += self.sock.send(self.down_view[self.down_start:])
+        except BlockingIOError:
+            return
+        self.down_view = None
+
+    def update(self):
+        """
+        Registers the events the pipe is waiting for, and closes it once both directions are done
+        """
+        if self.closed:
+            return
+        up_done = self.sock_eof and self.up_start >= self.up_end
+        down_done = self.channel_eof and self.down_view is None
+        if up_done and down_done:
+            self.close()
+            return
+
+        sock_events = 0
+        if not self.sock_eof and self.up_start >= self.up_end:
+            sock_events |= selectors.EVENT_READ
+        if self.down_view is not None:
+            sock_events |= selectors.EVENT_WRITE
+        channel_events = selectors.EVENT_READ if not self.channel_eof and self.down_view is None else 0
+        self._register(self.sock, "sock", sock_events)
+        self._register(self.channel, "channel", channel_events)
+
+    def close(self):
+        """
+        Closes both sides of the connection
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for fileobj in list(self.registered):
+            self._register(fileobj, None, 0)
+        self.relay.pipes.discard(self)
+        try:
+            self.channel.close()
+        except CONNECTION_ERRORS:
+            pass
+        self.sock.close()
+        print("Tunnel closed from {}".format(self.peername))
+
+    def _register(self, fileobj, side, events):
+        """
+        Changes the events of the socket or channel that the selector waits for
+        """
+        current = self.registered.get(fileobj, 0)
+        if events == current:
+            return
+        if current == 0:
+            self.relay.selector.register(fileobj, events, (self, side))
+        elif events == 0:
+            self.relay.selector.unregister(fileobj)
+        else:
+            self.relay.selector.modify(fileobj, events, (self, side))
+        if events:
+            self.registered[fileobj] = events
+        else:
+            self.registered.pop(fileobj, None)
@@ -1,18 +1,39 @@
 """
 This file contains a SSH tunneler that works with CAE 2FA
 """
+import contextlib
+import getpass
 import paramiko
+import posixpath
 import socketserver
-import select
 import threading
+import time
+from wa_infra_tools.ssh_utils.Relay import Relay
+
+# flow control of the SFTP sessions: paramiko's default window (2 MiB) is used up long before the
+# server's acknowledgement comes back on a high latency link, which stalls every transfer
+SFTP_WINDOW_SIZE = 32 * 1024 * 1024
+SFTP_PACKET_SIZE = 32 * 1024
 
 class ForwardServer(socketserver.ThreadingTCPServer):
     """
-    Server that manages the ssh tunnel
+    Server that manages the ssh tunnel. Its threads only open the channel of each connection,
+    the data is then moved by a Relay
     """
     daemon_threads = True
     allow_reuse_address = True
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # connections handed to the relay, which closes them itself
+        self.relayed = set()
+
+    def shutdown_request(self, request):
+        if request in self.relayed:
+            self.relayed.discard(request)
+        else:
+            super().shutdown_request(request)
+
 class Handler(socketserver.BaseRequestHandler):
     """
     Class to manage initial tunneling request
@@ -29,6 +50,10 @@ class Handler(socketserver.BaseRequestHandler):
     def transport(self):
         return self.transport
 
+    @property
+    def relay(self):
+        return self.relay
+
     def handle(self):
         channel = None
         try:
@@ -47,23 +72,9 @@ class Handler(socketserver.BaseRequestHandler):
 
         print("Connected! Tunnel open {} -> {} -> {}".format(self.request.getpeername(), channel.getpeername(), (self.chan_host, self.chan_port)))
 
-        while True:
-            read_list = select.select([self.request, channel], [], [])[0]
-            if self.request in read_list:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                channel.send(data)
-            if channel in read_list:
-                data = channel.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
-
-        peername = self.request.getpeername()
-        channel.close()
-        self.request.close()
-        print("Tunnel closed from {}".format(peername))
+        # the relay owns the connection from here on, so the server must not close it when handle returns
+        self.server.relayed.add(self.request)
+        self.relay.add(self.request, channel)
 
 class SSHTunnel:
     """
@@ -74,15 +85,18 @@ class SSHTunnel:
     @param hostname - name or ip address of the remote server
     @param remote_host - host we want to tunnel to within the remote server
     @param remote_port - port of the remote host we want to tunnel to 
+    @param relay - relay that moves the data of the forwarded connections (default: a new Relay)
     """
-    def __init__(self, transport, local_port, remote_host, remote_port=22):
+    def __init__(self, transport, local_port, remote_host, remote_port=22, relay=None):
         self.transport = transport
+        self.relay = relay or Relay()
 
         # initialize the fields of the handler using this subhandler class (we need to pass a class name into the forward server)
         class SubHandler(Handler):
             chan_host = remote_host
             chan_port = remote_port
             transport = self.transport
+            relay = self.relay
 
         self.forward_server = ForwardServer(("", local_port), SubHandler)
         self.is_active = False
@@ -111,19 +125,199 @@ class SSHTunnel:
             self.forward_server.server_close()
             self.is_active = False
 
+    def set_transport(self, transport):
+        """ Opens the channels of new connections on another transport (after a reconnect) """
+        self.transport = transport
+        self.forward_server.RequestHandlerClass.transport = transport
+
+class RemoteCommandError(IOError):
+    """
+    Raised when a command run on the remote machine exits with an error
+    """
+    pass
+
 class SSHClient:
-    def __init__(self, username, hostname):
-        self.transport = paramiko.Transport(hostname)
-        self.transport.connect(username=username)
-        self.transport.auth_interactive_dumb(username)
+    def __init__(self, username, hostname, keepalive=30, monitor_interval=None, sftp_sessions=8, sftp_window_size=SFTP_WINDOW_SIZE, sftp_packet_size=SFTP_PACKET_SIZE):
+        """
+        Connects to hostname, asking for the password/2FA prompts of the server
+
+        @param username : str           - username to login to the ssh server
+        @param hostname : str           - name or ip address of the remote server
+        @param keepalive : int          - seconds between keepalive packets sent on the connection (default: 30)
+        @param monitor_interval : int   - probe the connection this often (in seconds) from a background thread
+                                          and reconnect when it is lost (default: None, no monitoring)
+        @param sftp_sessions : int      - number of SFTP sessions leased by sftp(), i.e. transfers that can run at once (default: 8)
+        @param sftp_window_size : int   - flow control window of each SFTP session in bytes (default: 32 MiB)
+        @param sftp_packet_size : int   - largest packet accepted on each SFTP session in bytes (default: 32 KiB)
+        """
+        self.username = username
+        self.hostname = hostname
+        self.keepalive = keepalive
+        self.reconnects = 0
+
+        # answers typed at the login prompts, reused when reconnecting (kept in memory only)
+        self._answers = {}
+        self._lock = threading.RLock()
+        self._closed = False
+
+        self.transport = self._connect()
 
         # create dict for forward servers
         self.forward_servers = {}
 
-        # create sftp client
-        self.sftp_client = paramiko.SFTPClient.from_transport(self.transport)
+        # one event loop moves the data of the connections of every tunnel
+        self.relay = Relay()
+
+        # pool of SFTP sessions on the transport, opened as they are first needed
+        self.sftp_sessions = sftp_sessions
+        self.sftp_window_size = sftp_window_size
+        self.sftp_packet_size = sftp_packet_size
+        self._sftp_idle = []
+        self._sftp_slots = threading.BoundedSemaphore(sftp_sessions)
+        self._sftp_lock = threading.Lock()
+        self._sftp_client = None
+
+        # remote directories created through this client (and their parents), which make_dirs skips
+        self._made_dirs = set()
+        self._dirs_lock = threading.Lock()
+
+        if monitor_interval is not None:
+            threading.Thread(target=self._monitor, args=(monitor_interval,), name="ssh-monitor", daemon=True).start()
+
+    def is_alive(self, timeout=10):
+        """
+        Probes the connection with a round trip to the server (opening and closing a channel)
+
+        @param timeout : float  - seconds to wait for the server (default: 10)
+        @return bool            - whether the server answered
+        """
+        if not self.transport.is_active():
+            return False
+        try:
+            self.transport.open_session(timeout=timeout).close()
+            return True
+        except (paramiko.SSHException, OSError, EOFError):
+            return False
+
+    def ensure_connected(self, probe=False):
+        """
+        Reconnects if the connection has been lost. Safe to call from several threads at once,
+        only the first one reconnects
+
+        @param probe : bool - check the connection with a round trip to the server (is_alive) instead of only
+                              the state of the transport, which also catches a connection that died silently (default: False)
+        @return bool        - whether a reconnect was needed
+        """
+        with self._lock:
+            if self.is_alive() if probe else self.transport.is_active():
+                return False
+            print(f"Lost the connection to {self.hostname}, reconnecting")
+            self.reconnect()
+            return True
+
+    def reconnect(self, retries=5, backoff=1.0):
+        """
+        Replaces the connection with a new one, then moves the tunnels (their local ports stay open)
+        and the sftp client onto it. The login prompts are answered with the answers given earlier,
+        the user is only asked again if those are rejected
+
+        @param retries : int    - attempts before giving up (default: 5)
+        @param backoff : float  - seconds to wait after the first failed attempt, doubled after every attempt (default: 1.0)
+        """
+        with self._lock:
+            for attempt in range(retries):
+                try:
+                    transport = self._connect()
+                    break
+                except (paramiko.SSHException, OSError, EOFError) as e:
+                    if attempt == retries - 1:
+                        raise
+                    print(f"Failed to reconnect to {self.hostname} ({e}), retrying")
+                    time.sleep(backoff * 2 ** attempt)
+
+            old_transport, self.transport = self.transport, transport
+            old_transport.close()
+            for tunnel in self.forward_servers.values():
+                tunnel.set_transport(transport)
+            # sessions of the old transport are dead, leased ones are dropped when they are returned
+            self.close_sftp_sessions()
+            self._sftp_client = None
+            self.reconnects += 1
+            print(f"Reconnected to {self.hostname}")
+
+    def close(self):
+        """
+        Stops the tunnels and monitoring and closes the connection
+        """
+        self._closed = True
+        self.stop_tunnels()
+        self.relay.close()
+        self.close_sftp_sessions()
+        self.transport.close()
+
+    def _connect(self):
+        """
+        Opens and authenticates a new transport
+
+        @return paramiko.Transport - connected transport
+        """
+        transport = paramiko.Transport(self.hostname)
+        try:
+            transport.set_keepalive(self.keepalive)
+            transport.connect(username=self.username)
+            try:
+                transport.auth_interactive(self.username, self._answer_prompts)
+            except paramiko.AuthenticationException:
+                if not self._answers:
+                    raise
+                # the saved answers were rejected (e.g. a one time passcode), ask the user again
+                self._answers = {}
+                transport.auth_interactive(self.username, self._answer_prompts)
+        except BaseException:
+            transport.close()
+            raise
+        return transport
+
+    def _answer_prompts(self, title, instructions, prompt_list):
+        """
+        Answers the keyboard-interactive (password/2FA) prompts of the server, asking the user
+        for any prompt that has no saved answer
+        """
+        if prompt_list and all(prompt in self._answers for prompt, _ in prompt_list):
+            return [self._answers[prompt] for prompt, _ in prompt_list]
+
+        if title:
+            print(title.strip())
+        if instructions:
+            print(instructions.strip())
+        answers = []
+        for prompt, echo in prompt_list:
+            answer = input(prompt) if echo else getpass.getpass(prompt)
+            self._answers[prompt] = answer
+            answers.append(answer)
+        return answers
+
+    def _monitor(self, interval):
+        """
+        Background thread that probes the connection every interval seconds and reconnects when it is lost
+        """
+        while True:
+            time.sleep(interval)
+            if self._closed:
+                return
+            try:
+                self.ensure_connected(probe=True)
+            except Exception as e:
+                print(f"Failed to reconnect to {self.hostname}: {e}")
 
     def exec_command(self, command):
+        """
+        Starts a command on the remote machine. The caller owns the channel of the returned streams
+        and must close it (stdout.channel.close()); use run to wait for a command and clean up
+
+        @param command : str                                - shell command to run
+        @return Tuple[ChannelFile, ChannelFile, ChannelFile] - stdin, stdout and stderr of the command
+        """
         channel = self.transport.open_session()
         channel.exec_command(command)
         stdin = channel.makefile_stdin("wb", -1) 
@@ -131,9 +325,151 @@ class SSHClient:
         stderr = channel.makefile_stderr("r", -1) 
         return stdin, stdout, stderr
 
+    def run(self, command, stdin=None):
+        """
+        Runs a command on the remote machine and waits for it to finish, then closes its channel.
+        The output is read after stdin has been sent, so commands fed with stdin should not write much
+
+        @param command : str    - shell command to run
+        @param stdin : bytes    - data written to the standard input of the command, which is then closed (default: None)
+        @return bytes           - standard output of the command
+        """
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command(command)
+            if stdin:
+                channel.sendall(stdin)
+            channel.shutdown_write()
+            stdout = channel.makefile("rb", -1).read()
+            stderr = channel.makefile_stderr("rb", -1).read()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if status != 0:
+            raise RemoteCommandError(f"Remote command failed ({status}): {stderr.decode(errors='replace').strip()}")
+        return stdout
+
+    def run_batched(self, commands):
+        """
+        Runs many commands on the remote machine as one script sent to a single shell, stopping at the
+        first command that fails. However many commands there are, this is one round trip
+
+        @param commands : Iterable[str] - shell commands to run in order
+        """
+        script = "".join(command + "\n" for command in commands)
+        if script:
+            self.run("sh -e", script.encode())
+
+    def make_dirs(self, remote_dirs):
+        """
+        Creates directories (and their parents) on the remote machine in one round trip. Directories
+        created earlier through this client are skipped, and a directory is not sent when one of its
+        subdirectories is (mkdir -p creates it anyway)
+
+        @param remote_dirs : Iterable[str]  - directories to create
+        @return int                         - number of directories sent to the remote machine
+        """
+        with self._dirs_lock:
+            remote_dirs = {posixpath.normpath(remote_dir) for remote_dir in remote_dirs} - self._made_dirs
+        parents = set()
+        for remote_dir in remote_dirs:
+            parent = posixpath.dirname(remote_dir)
+            while parent not in parents and parent != posixpath.dirname(parent):
+                parents.add(parent)
+                parent = posixpath.dirname(parent)
+        leaves = sorted(remote_dirs - parents)
+        if leaves:
+            self.run("xargs -0 mkdir -p --", "\0".join(leaves).encode())
+        with self._dirs_lock:
+            self._made_dirs |= remote_dirs | parents
+        return len(leaves)
+
+    def remove_dirs(self, remote_dirs):
+        """
+        Removes empty directories on the remote machine in one round trip (subdirectories before their parents)
+
+        @param remote_dirs : Iterable[str] - directories to remove
+        """
+        remote_dirs = sorted({posixpath.normpath(remote_dir) for remote_dir in remote_dirs}, reverse=True)
+        if remote_dirs:
+            self.run("xargs -0 rmdir --", "\0".join(remote_dirs).encode())
+        with self._dirs_lock:
+            self._made_dirs.difference_update(remote_dirs)
+
+    @contextlib.contextmanager
+    def sftp(self):
+        """
+        Leases one of the pooled SFTP sessions for the duration of the block, opening it if needed. Each
+        session is its own channel on the transport, so transfers in different threads run side by side.
+        If all sftp_sessions are leased, waits for one to be returned. A session whose block raised
+        is closed instead of returned, in case the error left it unusable
+
+            with client.sftp() as sftp:
+                sftp.put(local_filepath, remote_path)
+
+        @return paramiko.SFTPClient - leased session
+        """
+        self._sftp_slots.acquire()
+        try:
+            with self._sftp_lock:
+                sftp = self._sftp_idle.pop() if self._sftp_idle else None
+            if sftp is None:
+                sftp = self._open_sftp()
+            try:
+                yield sftp
+            except BaseException:
+                self._close_sftp(sftp)
+                raise
+            channel = sftp.get_channel()
+            if channel.closed or channel.get_transport() is not self.transport or self._closed:
+                self._close_sftp(sftp)
+            else:
+                with self._sftp_lock:
+                    self._sftp_idle.append(sftp)
+        finally:
+            self._sftp_slots.release()
+
+    def close_sftp_sessions(self):
+        """
+        Closes the pooled SFTP sessions that are not leased (they are reopened when needed)
+        """
+        with self._sftp_lock:
+            idle, self._sftp_idle = self._sftp_idle, []
+        for sftp in idle:
+            self._close_sftp(sftp)
+
+    @property
+    def sftp_client(self):
+        """
+        SFTP session shared by everything that calls get_sftp_client, outside the pool (opened on first use)
+        """
+        if self._sftp_client is None:
+            self._sftp_client = self._open_sftp()
+        return self._sftp_client
+
     def get_sftp_client(self):
         return self.sftp_client
 
+    def _open_sftp(self):
+        """
+        Opens an SFTP session on the transport with the configured window and packet sizes
+        """
+        return paramiko.SFTPClient.from_transport(
+            self.transport,
+            window_size=self.sftp_window_size,
+            max_packet_size=self.sftp_packet_size
+        )
+
+    @staticmethod
+    def _close_sftp(sftp):
+        """
+        Closes an SFTP session, ignoring errors of a connection that is already gone
+        """
+        try:
+            sftp.close()
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+
     def start_tunnels(self):
         # start all tunnels
         for tunnel in self.forward_servers.values():
@@ -159,7 +495,7 @@ class SSHClient:
         del self.forward_servers[(local_port, remote_host, remote_port)]
 
     def create_tunnel(self, local_port, remote_host, remote_port):
-        self.forward_servers[(local_port, remote_host, remote_port)] = SSHTunnel(self.transport, local_port, remote_host, remote_port)
+        self.forward_servers[(local_port, remote_host, remote_port)] = SSHTunnel(self.transport, local_port, remote_host, remote_port, self.relay)
 
     @property
     def tunnels(self):